@@ -154,6 +154,55 @@ def make_transition_matrices_charmm(sim_id, config):
     print("Transition matrices for {} assembled.".format(sim_id))
 
 
+def make_transition_matrices_native(sim_id, config):
+    """
+    Count the transition matrices without CHARMM, from the coordinate files
+    in the [count] section of the config file, see count.py.
+    The files are written where the CHARMM version would write them.
+
+    Args:
+        config: ConfigParser instance.
+        sim_id: ID of the replica.
+    """
+    import numpy as np
+    from count import count_transition_files
+    lag_start = int(config.get("general", "lag_start"))
+    lag_end = int(config.get("general", "lag_end"))
+    lag_inc = int(config.get("general", "lag_inc"))
+    lagtimes = range(lag_start, lag_end+1, lag_inc)
+    if all(os.path.isfile(tmat_file(config, sim_id, lt)) for lt in lagtimes):
+        print("Transition matrices for {} exists. Not updating.".format(sim_id))
+        return
+    print("Counting transition matrices natively:")
+
+    def get(option, default=None):
+        if config.has_option("count", option):
+            return config.get("count", option)
+        return default
+
+    zfiles = eval(config.get("count", "coordinates"))[sim_id]
+    nbins = int(get("nbins", 100))
+    if get("zpbc") is not None:
+        # bins scale with the box, as CHARMM's "edge CCEL"
+        zpbc = eval(get("zpbc"))[sim_id]
+        edges = np.linspace(-0.5, 0.5, nbins+1)
+        count = get("count", "pbc")
+    else:
+        zpbc = None
+        edges = np.linspace(float(get("zmin")), float(get("zmax")), nbins+1)
+        count = get("count", "cut")
+        if count == "pbc":
+            raise ValueError("count = pbc in [count] needs zpbc, use count = cut with zmin/zmax")
+    chunksize = get("chunksize")
+    counter = count_transition_files(
+        zfiles, edges, lagtimes, zpbc=zpbc,
+        nproc=int(get("nproc", 1)),
+        chunksize=None if chunksize is None else int(chunksize))
+    template = tmat_file(config, sim_id, "{}")
+    counter.write(template, float(get("dt", 1.)), count=count)
+    print("Transition matrices for {} assembled.".format(sim_id))
+
+
 def extract_density_charmm(sim_id, config, script, output_dir):
     """
     Wrapper for the CHARMM command to extract the transition matrix.
@@ -232,7 +281,11 @@ def process_all(config):
     # create matrices (parallelize over sim_ids)
     sim_ids = eval(config.get("general", "trajectories")).keys()
     mk_matrices = partial(make_transition_matrices_charmm, config=config)
-    if parallel:
+    if config.has_section("count"):
+        # native counting uses its own pool of processes
+        for id in sim_ids:
+            make_transition_matrices_native(id, config)
+    elif parallel:
         pool = multiprocessing.Pool(len(sim_ids))
         pool.map(mk_matrices, sim_ids)
         pool.close()
@@ -13,6 +13,8 @@ from mc import find_parameters
 from outreading import read_many_profiles
 from outreading import read_many_profiles_Drad
 from plot import make_plots
+from transitions import merge_transition_files
+from count import count_transition_files
 import charmm
 import ana
 
@@ -34,7 +36,14 @@ def run(options):
                 options.initfile,
                 options.k,
                 options.lmax,
-                options.reduction)
+                options.reduction,
+                rebin=options.rebin,
+                rebinrad=options.rebinrad,
+                logdir=options.logdir,
+                logfreq=options.logfreq,
+                printfreq=options.printfreq,
+                lazy=options.lazy,
+                cache_size=options.cache_size)
 
 
 def parse_run(parser):
@@ -114,6 +123,26 @@ def parse_run(parser):
     parser.add_argument("--reduction", dest="reduction", default=False,
                         action="store_true",
                         help="this keyword reduces the transition matrix by deleting zero rows/columns before starting the Monte Carlo")
+    parser.add_argument("--rebin", dest="rebin", default=1,
+                        type=int,
+                        help="merge every REBIN adjacent bins of the transition matrix before starting the Monte Carlo")
+    parser.add_argument("--rebinrad", dest="rebinrad", default=1,
+                        type=int,
+                        help="merge every REBINRAD adjacent radial bins of the radial transition matrix")
+    parser.add_argument("--logdir", dest="logdir", default=None,
+                        help="write the MC history to memory-mapped .npy files in directory LOGDIR during the run, instead of pickling it at the end (OUTFILE.pic)")
+    parser.add_argument("--logfreq", dest="logfreq", default=100,
+                        type=int,
+                        help="store the profiles every LOGFREQ MC steps (mean and std are computed from every step anyway)")
+    parser.add_argument("--printfreq", dest="printfreq", default=100,
+                        type=int,
+                        help="print log-likelihood and acceptance every PRINTFREQ MC steps")
+    parser.add_argument("--lazy", dest="lazy", default=False,
+                        action="store_true",
+                        help="read the transition matrix of a lag time only when it is used, for many lag times (not for radial)")
+    parser.add_argument("--cache_size", "--cache-size", dest="cache_size", default=None,
+                        type=int,
+                        help="with --lazy, keep at most CACHE_SIZE transition matrices in memory (default all)")
     parser.set_defaults(func=run)
 
 
@@ -169,6 +198,109 @@ def parse_plot(parser):
     parser.set_defaults(func=plot)
 
 
+def merge(options):
+    print("options:")
+    print(options.__dict__)
+    print("="*20)
+    merge_transition_files(options.trans_mat_files, options.outfile,
+                           nproc=options.nproc, binary=options.binary)
+
+
+def parse_merge(parser):
+    parser.add_argument("trans_mat_files", nargs='+')
+    parser.add_argument("-o", "--outfile", dest="outfile", required=True,
+                        help="filename FILE where the summed transition counts will be stored")
+    parser.add_argument("-j", "--nproc", dest="nproc", default=1,
+                        type=int,
+                        help="number of processes that each sum a part of the files")
+    parser.add_argument("--binary", dest="binary", default=False,
+                        action="store_true",
+                        help="write the summed counts in binary numpy format instead of text (.npz is added to OUTFILE if missing)")
+    parser.set_defaults(func=merge)
+
+
+def count(options):
+    print("options:")
+    print(options.__dict__)
+    print("="*20)
+    import numpy as np
+    if options.zpbc is not None:
+        # bins scale with the box length of each frame
+        edges = np.linspace(-0.5, 0.5, options.nbins+1)
+        count = options.count or "pbc"
+    else:
+        assert options.zmin is not None and options.zmax is not None, \
+            "give --zmin and --zmax, or box lengths with --zpbc"
+        edges = np.linspace(options.zmin, options.zmax, options.nbins+1)
+        count = options.count or "cut"
+        if count == "pbc":
+            raise ValueError("--count pbc needs the box lengths (--zpbc), use --count cut with --zmin/--zmax")
+    redges = None
+    if options.nrad > 0:
+        redges = np.arange(options.nrad)*options.dr
+    counter = count_transition_files(options.coor_files, edges, options.lags,
+                        xfiles=options.xfiles, yfiles=options.yfiles,
+                        redges=redges, zpbc=options.zpbc,
+                        nproc=options.nproc, chunksize=options.chunksize,
+                        atomblock=options.atomblock)
+    for filename in counter.write(options.outfile, options.dt,
+                                  count=count, binary=options.binary):
+        print("file written...", filename)
+
+
+def parse_count(parser):
+    parser.add_argument("coor_files", nargs='+',
+                        help="z-coordinates, text files (one line per frame, one column per atom) or .npy arrays")
+    parser.add_argument("-o", "--outfile", dest="outfile", required=True,
+                        help="basename of the transition files, BASENAME.lag.count.dat, "
+                             "or a template with {} for the lag time")
+    parser.add_argument("-l", "--lags", dest="lags", nargs='+', required=True,
+                        type=int,
+                        help="lag times, in number of frames")
+    parser.add_argument("--nbins", dest="nbins", default=100,
+                        type=int,
+                        help="number of bins")
+    parser.add_argument("--zmin", dest="zmin", default=None,
+                        type=float,
+                        help="lowest bin edge")
+    parser.add_argument("--zmax", dest="zmax", default=None,
+                        type=float,
+                        help="highest bin edge")
+    parser.add_argument("--zpbc", dest="zpbc", nargs='+', default=None,
+                        help="box length of each coordinate file (a number, or a file with one line per frame), "
+                             "the NBINS bins then scale with the box")
+    parser.add_argument("--dt", dest="dt", default=1.,
+                        type=float,
+                        help="time between frames in ps")
+    parser.add_argument("--count", dest="count", default=None,
+                        choices=["pbc", "cut"],
+                        help="how to treat the bins outside the edges: pbc (only with --zpbc, the default then) "
+                             "or cut (leave them out, the default with --zmin/--zmax)")
+    parser.add_argument("--xfiles", dest="xfiles", nargs='+', default=None,
+                        help="x-coordinates, for radial transitions")
+    parser.add_argument("--yfiles", dest="yfiles", nargs='+', default=None,
+                        help="y-coordinates, for radial transitions")
+    parser.add_argument("--nrad", dest="nrad", default=0,
+                        type=int,
+                        help="number of radial bins (0 if no radial transitions)")
+    parser.add_argument("--dr", dest="dr", default=1.,
+                        type=float,
+                        help="width of the radial bins")
+    parser.add_argument("-j", "--nproc", dest="nproc", default=1,
+                        type=int,
+                        help="number of processes")
+    parser.add_argument("--chunksize", dest="chunksize", default=None,
+                        type=int,
+                        help="number of frames per task")
+    parser.add_argument("--atomblock", dest="atomblock", default=None,
+                        type=int,
+                        help="number of atoms per task")
+    parser.add_argument("--binary", dest="binary", default=False,
+                        action="store_true",
+                        help="write the counts in binary numpy format (.npz) instead of text")
+    parser.set_defaults(func=count)
+
+
 def get_config(config_file):
     assert os.path.isfile(config_file), "Config file not found."
     config = configparser.ConfigParser()
@@ -238,6 +370,8 @@ def main():
     subparsers = main_parser.add_subparsers(title="subcommands", description="")
     parse_run(subparsers.add_parser("run"))
     parse_plot(subparsers.add_parser("plot"))
+    parse_merge(subparsers.add_parser("merge"))
+    parse_count(subparsers.add_parser("count"))
     parse_chm(subparsers.add_parser("chm"))
     parse_chm_density(subparsers.add_parser("chm_density"))
     parse_analysis(subparsers.add_parser("analysis"))
@@ -0,0 +1,167 @@
+"""
+Count transition matrices from coordinate files with a pool of processes,
+a native replacement for Rick's modified CHARMM version (see charmm.py).
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+from functools import partial
+
+import numpy as np
+
+from mcdiff.tools.extract import TransitionCounter
+from mcdiff.tools.textio import read_text
+
+
+def load_coordinates(filename):
+    """
+    Coordinates of one file as an array ntime x natom.
+
+    Args:
+        filename: NumPy file (.npy, memory-mapped) or plain-text file with
+            one frame per line and one column per atom, see
+            tools.histogram.read_coor.
+    """
+    if filename.endswith(".npy"):
+        data = np.load(filename, mmap_mode="r")
+    else:
+        data = read_text(filename)
+    if len(data.shape) == 1:
+        data = data.reshape((-1, 1))
+    assert len(data.shape) == 2, "expected array ntime x natom in {}".format(filename)
+    return data
+
+
+def load_box(item, ntime):
+    """
+    Box lengths of each frame, from a file with one line per frame,
+    or a number for a constant box.
+    """
+    try:
+        return float(item) * np.ones(ntime)
+    except ValueError:
+        zpbc = np.ravel(load_coordinates(item))
+        assert len(zpbc) == ntime, ("box file {} has {} frames instead of {}".format(
+            item, len(zpbc), ntime))
+        return zpbc
+
+
+# coordinates shared with the worker processes
+_DATA = []
+
+
+def _init_worker(data):
+    global _DATA
+    _DATA = data
+
+
+def count_task(task, edges, shifts, redges=None):
+    """
+    Count the transitions of one part of one trajectory.
+
+    Args:
+        task: (ifile, t0, t1, a0, a1), count the transitions that end
+            in frames t0 to t1 of atoms a0 to a1 of file ifile.
+    Returns:
+        A TransitionCounter.
+    """
+    ifile, t0, t1, a0, a1 = task
+    z, x, y, zpbc = _DATA[ifile]
+    counter = TransitionCounter(edges, shifts, redges=redges)
+
+    def part(start, end):
+        kwargs = {}
+        if x is not None:
+            kwargs["x"] = x[start:end, a0:a1]
+            kwargs["y"] = y[start:end, a0:a1]
+        if zpbc is not None:
+            kwargs["zpbc"] = zpbc[start:end]
+        return z[start:end, a0:a1], kwargs
+
+    first = max(0, t0 - counter.maxshift)
+    if first < t0:
+        zpart, kwargs = part(first, t0)
+        counter.skip(zpart, **kwargs)
+    zpart, kwargs = part(t0, t1)
+    counter.add(zpart, **kwargs)
+    counter.tail = None   # no need to send it back
+    return counter
+
+
+def make_tasks(data, chunksize=None, atomblock=None):
+    """
+    Split all trajectories in chunks of frames and blocks of atoms.
+    """
+    tasks = []
+    for ifile, (z, x, y, zpbc) in enumerate(data):
+        ntime, natom = z.shape
+        tstep = chunksize or ntime
+        astep = atomblock or natom
+        for t0 in range(0, ntime, tstep):
+            for a0 in range(0, natom, astep):
+                tasks.append((ifile, t0, min(t0 + tstep, ntime),
+                              a0, min(a0 + astep, natom)))
+    return tasks
+
+
+def count_transition_files(zfiles, edges, shifts, xfiles=None, yfiles=None,
+                           redges=None, zpbc=None, nproc=1, chunksize=None,
+                           atomblock=None):
+    """
+    Count the transitions for several lag shifts in a set of trajectories,
+    all atoms and trajectories added.
+
+    Args:
+        zfiles: list of coordinate files, arrays ntime x natom, see load_coordinates.
+        edges: bin edges, or bin edges in units of the box length when zpbc is given.
+        shifts: lag shifts (number of frames).
+        xfiles, yfiles: coordinate files for the radial transitions.
+        redges: radial bin edges [0,dr,...].
+        zpbc: for each zfile the box lengths (file or number), the bins
+            then scale with the box (NPT).
+        nproc: number of processes.
+        chunksize: number of frames per task, default the whole trajectory.
+        atomblock: number of atoms per task, default all atoms.
+    Returns:
+        A TransitionCounter with the summed counts.
+    """
+    if redges is not None:
+        assert xfiles is not None and yfiles is not None, \
+            "radial transitions need x and y coordinates"
+        assert len(xfiles) == len(zfiles) and len(yfiles) == len(zfiles)
+    if zpbc is not None:
+        assert len(zpbc) == len(zfiles)
+    data = []
+    for i, zfile in enumerate(zfiles):
+        z = load_coordinates(zfile)
+        x = y = box = None
+        if redges is not None:
+            x = load_coordinates(xfiles[i])
+            y = load_coordinates(yfiles[i])
+            assert x.shape == z.shape and y.shape == z.shape
+        if zpbc is not None:
+            box = load_box(zpbc[i], len(z))
+        data.append((z, x, y, box))
+        print("coordinates", zfile, z.shape)
+
+    tasks = make_tasks(data, chunksize=chunksize, atomblock=atomblock)
+    print("counting transitions: {} tasks, {} processes".format(len(tasks), nproc))
+    count_one = partial(count_task, edges=edges, shifts=shifts, redges=redges)
+    total = TransitionCounter(edges, shifts, redges=redges)
+    # merge each counter when it arrives, only a few are in memory at once
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc, initializer=_init_worker, initargs=(data,))
+        for counter in pool.imap_unordered(count_one, tasks):
+            total.merge(counter)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(data)
+        for task in tasks:
+            total.merge(count_one(task))
+    # every atom is counted for every frame
+    total.nframes = sum(len(d[0]) for d in data)
+    if zpbc is not None:
+        total.zpbc_sum = sum(np.sum(d[3]) for d in data)
+    return total
@@ -2,48 +2,150 @@
 Logger functionality to store the history of a Monte-Carlo run.
 """
 
+import os
+import copy
+import json
+import pickle
 import numpy as np
 
 
+class RunningStats(object):
+    """
+    Running mean and variance of a set of quantities (Welford's algorithm),
+    updated every MC step without storing the samples.
+    """
+    def __init__(self,sizes):
+        """
+        Args:
+            sizes: list of (name, size) of the quantities, in the order
+                in which add receives them.
+        """
+        self.names = [name for name,size in sizes]
+        self.slices = {}
+        start = 0
+        for name,size in sizes:
+            self.slices[name] = slice(start,start+size)
+            start += size
+        self.n = 0
+        self.mean = np.zeros(start,float)
+        self.m2 = np.zeros(start,float)   # sum of squared deviations from the mean
+
+    def add(self,values):
+        """
+        Add one sample, values is a list of numbers or arrays in the order of names.
+        """
+        x = np.concatenate([np.ravel(val) for val in values])
+        self.n += 1
+        delta = x-self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x-self.mean)
+
+    def merge(self,other):
+        """
+        Add the samples of another RunningStats with the same quantities.
+        """
+        assert self.names == other.names
+        n = self.n+other.n
+        if n == 0:
+            return
+        delta = other.mean-self.mean
+        self.m2 += other.m2 + delta**2*self.n*other.n/float(n)
+        self.mean += delta*other.n/float(n)
+        self.n = n
+
+    def get(self,name):
+        """
+        Returns:
+            Mean and standard deviation of quantity name, like np.mean and np.std
+            of all samples.
+        """
+        sl = self.slices[name]
+        return self.mean[sl].copy(), np.sqrt(self.m2[sl]/max(self.n,1))
+
+
 class Logger(object):
     """
     Container class to store the history of a MC run.
     """
-    def __init__(self,MC):
+    def __init__(self,MC,freq=100):
         """
         Args:
             MC: MCState instance.
+            freq: store every freq-th MC step.
         """
         self.nmc = MC.nmc           # ! Number of Monte Carlo steps
-        self.freq = 100             # ! Saving frequency
+        self.freq = freq            # ! Saving frequency
         nf = MC.nmc/self.freq+1     # if n=1000, then I want 11 stores / if n=999, then I want 10 stores
         self.nf = nf                # ! Number of frames in Logger
 
         # arrays
-        self.log_like  = np.zeros((nf),float)   # ! Log-likelihood
-        self.timezero  = np.zeros((nf),float)
-        self.dv        = np.zeros((nf),float)   # !
-        self.dw        = np.zeros((nf),float)
-        self.dwrad     = np.zeros((nf),float)
-        self.dtimezero = np.zeros((nf),float)
+        self.log_like  = self.allocate("log_like",(nf,))   # ! Log-likelihood
+        self.timezero  = self.allocate("timezero",(nf,))
+        self.dv        = self.allocate("dv",(nf,))   # !
+        self.dw        = self.allocate("dw",(nf,))
+        self.dwrad     = self.allocate("dwrad",(nf,))
+        self.dtimezero = self.allocate("dtimezero",(nf,))
         #self.Ew        = np.zeros((nf),float)
         if MC.model.ncosF <= 0:
-            self.v       = np.zeros((nf,MC.model.dim_v),float)
+            self.v       = self.allocate("v",(nf,MC.model.dim_v))
         else:
-            self.v_coeff = np.zeros((nf,MC.model.ncosF),float)
+            self.v_coeff = self.allocate("v_coeff",(nf,MC.model.ncosF))
         if MC.model.ncosD <= 0:
-            self.w       = np.zeros((nf,MC.model.dim_w),float)
+            self.w       = self.allocate("w",(nf,MC.model.dim_w))
         else:
-            self.w_coeff = np.zeros((nf,MC.model.ncosD),float)
+            self.w_coeff = self.allocate("w_coeff",(nf,MC.model.ncosD))
         if MC.do_radial:
             if MC.model.ncosDrad <= 0:
-                self.wrad = np.zeros((nf,MC.model.dim_wrad),float)
+                self.wrad = self.allocate("wrad",(nf,MC.model.dim_wrad))
             else:
-                self.wrad_coeff = np.zeros((nf,MC.model.ncosDrad),float)
+                self.wrad_coeff = self.allocate("wrad_coeff",(nf,MC.model.ncosDrad))
+
+        # running statistics of every step, created at the first step
+        self.running = None
+
+    def running_values(self,MC):
+        """
+        Quantities of the running statistics: profiles per bin (and exp(w),
+        the diffusion coefficient without unit) and coefficients.
+
+        Returns:
+            List of (name, value).
+        """
+        model = MC.model
+        values = [("log_like",MC.log_like), ("timezero",model.timezero),
+                  ("v",model.v), ("w",model.w), ("d",np.exp(model.w))]
+        if model.ncosF > 0:
+            values.append(("v_coeff",model.v_coeff))
+        if model.ncosD > 0:
+            values.append(("w_coeff",model.w_coeff))
+        if MC.do_radial:
+            values += [("wrad",model.wrad), ("drad",np.exp(model.wrad))]
+            if model.ncosDrad > 0:
+                values.append(("wrad_coeff",model.wrad_coeff))
+        return values
+
+    def allocate(self,name,shape):
+        """
+        Array for the history of one quantity, all frames.
+        """
+        return np.zeros(shape,float)
 
     def log(self, j, MC):  # j is counter, counting starts with 1, ends with nmc
+        """
+        Store the state of step j if it is a multiple of freq, and add
+        every step after the start (j > 0) to the running statistics.
+
+        Returns:
+            Whether the frame was stored.
+        """
+        if j > 0:
+            values = self.running_values(MC)
+            if self.running is None:
+                self.running = RunningStats([(name,np.size(val)) for name,val in values])
+            self.running.add([val for name,val in values])
         i = j/self.freq   # if n=1000, freq=100, then store 0,100,...,900,1000 
-        if i*self.freq == j:
+        stored = i*self.freq == j
+        if stored:
             #print i,j,self.freq,self.v.shape,MC.model.v.shape
             self.log_like[i]  = MC.log_like
             self.timezero[i]  = MC.model.timezero
@@ -65,6 +167,7 @@ class Logger(object):
                     self.wrad_coeff[i,:] = MC.model.wrad_coeff[:]
                 else:
                     self.wrad[i,:] = MC.model.wrad[:]
+        return stored
 
     def prettyprint(self,f):
         #f = file(filename+"2","w+")
@@ -76,7 +179,6 @@ class Logger(object):
 
     def dump(self,filename):
         f = file(filename,"w+")
-        import pickle
         pickle.dump(self,f)
         f.close()
 
@@ -97,18 +199,43 @@ class Logger(object):
         print >>f, "-"*20
 
 
+    def profiles(self,name,model=None):
+        """
+        History of profile v, w or wrad, all stored frames at once.
+
+        With basis functions, the profiles are built from the stored
+        coefficients in one matrix product, coeff_history x basis.T.
+
+        Returns:
+            Array nf x len(profile).
+        """
+        if hasattr(self,name):   # profile itself was stored
+            return getattr(self,name)
+        if model is None:
+            model = self.model
+        return np.dot(getattr(self,name+"_coeff"),getattr(model,name+"_basis").T)
+
+    def profile_statistics(self,name,model=None,st=0,quantiles=(5,50,95)):
+        """
+        Args:
+            name: v, w or wrad.
+            st: start, the first st MC steps are left out.
+            quantiles: percentiles to compute per bin.
+        Returns:
+            All profiles (frames x bins), their mean, standard deviation
+            and quantiles (len(quantiles) x bins), per bin.
+        """
+        a = self.profiles(name,model)[st/self.freq:]
+        return a, np.mean(a,0), np.std(a,0), np.percentile(a,quantiles,axis=0)
+
     def average_profile_v_from_coeff(self,):
-        a = np.zeros((self.nf,self.model.dim_v))
-        for i in xrange(len(a)):
-            a[i,:] = self.model.calc_profile(self.v_coeff[i,:],self.model.v_basis)
+        a = self.profiles("v")
         v = np.mean(a,0)
         vst = np.std(a,0)
         return v,vst
 
     def average_profile_w_from_coeff(self,):
-        a = np.zeros((self.nf,self.model.dim_w))
-        for i in xrange(len(a)):
-            a[i,:] = self.model.calc_profile(self.w_coeff[i,:],self.model.w_basis)
+        a = self.profiles("w")
         w = np.mean(a,0)
         wst = np.std(a,0)
         d = np.mean(np.exp(a),0)        # unit is missing
@@ -116,9 +243,7 @@ class Logger(object):
         return w,wst,d,dst
 
     def average_profile_wrad_from_coeff(self,):
-        a = np.zeros((self.nf,self.model.dim_wrad))
-        for i in xrange(len(a)):
-            a[i,:] = self.model.calc_profile(self.wrad_coeff[i,:],self.model.wrad_basis)
+        a = self.profiles("wrad")
         wrad = np.mean(a,0)
         wradst = np.std(a,0)
         drad = np.mean(np.exp(a),0)     # unit is missing
@@ -137,12 +262,18 @@ class Logger(object):
         print_coeffs(sys.stdout,model,v_coeff,w_coeff,wrad_coeff,timezero,final=True,)
         print_profiles(sys.stdout,model,F,D,Drad,final=True,error=error,unit="notinternal")
 
-    def statistics(self,MC,st=0):
+    def statistics(self,MC,st=None):
 
         # TODO I should change the function statistics
         # statistics_print versus statistics no print
 
-        # st  --  start (cutting out the first MC steps)
+        # st  --  start (cutting out the first MC steps), statistics of the stored frames
+        #         None: running statistics of all MC steps
+        if st is None:
+            if getattr(self,"running",None) is not None:   # not in older versions
+                self.print_running()
+                return
+            st = 0
         s = st/self.freq
         if s >= self.nf:
             print "WARNING: supposed to skip %i MC steps, i.e. %i frames, but skipped none" %(self.nmc,s)
@@ -151,46 +282,46 @@ class Logger(object):
             # vec has dimension  nsamples-in-MC x len(profile)
             print "VEC",vec.shape
             assert len(vec.shape) == 2
+            mean = np.mean(vec[s:],0)
+            std = np.std(vec[s:],0)
             for i in range(vec.shape[1]):
-                print i, np.mean(vec[s:,i]),np.std(vec[s:,i])
+                print i, mean[i], std[i]
 
         # Free energy
         print "===== stat v ====="
-        if MC.model.ncosF <= 0:
-            print_vector(self.v,s)
-        else:
-            vec = np.zeros((self.nf,MC.model.dim_v),float)
-            for i in range(len(vec)):
-                vec[i,:] = MC.model.calc_profile(self.v_coeff[i,:],MC.model.v_basis)
-            print_vector(vec,s)
+        print_vector(self.profiles("v",MC.model),s)
+        if MC.model.ncosF > 0:
             print "===== stat v_coeff ====="
             print_vector(self.v_coeff,s)
 
         # Diffusion profile
         print "===== stat w ====="
-        if MC.model.ncosD <= 0:
-            print_vector(self.w,s)
-        else:
-            vec = np.zeros((self.nf,MC.model.dim_w),float)
-            for i in range(len(vec)):
-                vec[i,:] = MC.model.calc_profile(self.w_coeff[i,:],MC.model.w_basis)
-            print_vector(vec,s)
+        print_vector(self.profiles("w",MC.model),s)
+        if MC.model.ncosD > 0:
             print "===== stat w_coeff ====="
             print_vector(self.w_coeff,s)
 
         # Radial diffusion profile
         if MC.do_radial:
             print "===== stat wrad ====="
-            if MC.model.ncosDrad <= 0:
-                print_vector(self.wrad,s)
-            else:
-                vec = np.zeros((self.nf,MC.model.dim_wrad),float)
-                for i in range(len(vec)):
-                    vec[i,:] = MC.model.calc_profile(self.wrad_coeff[i,:],MC.model.wrad_basis)
-                print_vector(vec,s)
+            print_vector(self.profiles("wrad",MC.model),s)
+            if MC.model.ncosDrad > 0:
                 print "===== stat wrad_coeff ====="
                 print_vector(self.wrad_coeff,s)
 
+    def print_running(self):
+        """
+        Print mean and standard deviation of the profiles and coefficients
+        over all MC steps, from the running statistics.
+        """
+        print "running statistics of %i MC steps (%i frames stored)" %(self.running.n,self.nf)
+        for name in self.running.names:
+            if name in ["log_like","timezero","d","drad"]:
+                continue
+            mean,std = self.running.get(name)
+            print "===== stat %s =====" %name
+            for i in range(len(mean)):
+                print i, mean[i], std[i]
 
     def plot_likelihood(self,figname):
         import matplotlib.pyplot as plt
@@ -200,6 +331,75 @@ class Logger(object):
         plt.savefig(figname)
 
 
+class StreamLogger(Logger):
+    """
+    Logger that writes the history to disk while the MC run goes on.
+
+    Every array of Logger is a memory-mapped .npy file in a directory,
+    allocated for all frames at the start; the file system only fills the
+    frames that are written, so the size of the run is not limited by the
+    memory and every step can be stored (freq=1). The number of stored
+    frames is updated after each frame (nstored.npy), such that a run that
+    is still going on, or that crashed, can be opened with load_logger.
+    """
+    def __init__(self,MC,dirname,freq=100):
+        """
+        Args:
+            MC: MCState instance, with its model set.
+            dirname: directory for the .npy files, created if needed.
+            freq: store every freq-th MC step.
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.dirname = dirname
+        self.arrays = []
+        Logger.__init__(self,MC,freq=freq)
+        self.nstored = np.lib.format.open_memmap(os.path.join(dirname,"nstored.npy"),
+                           mode="w+",dtype=int,shape=(1,))
+        meta = {"nmc":self.nmc, "freq":self.freq, "nf":self.nf,
+                "arrays":self.arrays}
+        f = open(os.path.join(dirname,"logger.json"),"w")
+        json.dump(meta,f,indent=1,sort_keys=True)
+        f.close()
+        self.model = MC.model   # this is not a hard copy
+        self.dump_model()
+
+    def allocate(self,name,shape):
+        self.arrays.append(name)
+        return np.lib.format.open_memmap(os.path.join(self.dirname,name+".npy"),
+                   mode="w+",dtype=float,shape=shape)
+
+    def log(self, j, MC):
+        stored = Logger.log(self,j,MC)
+        if stored:
+            self.nstored[0] = j/self.freq+1   # only after the frame itself
+        return stored
+
+    def dump_model(self):
+        f = file(os.path.join(self.dirname,"model.pic"),"w+")
+        pickle.dump(self.model,f)
+        f.close()
+
+    def flush(self):
+        """
+        Write the frames to disk now (they are safe from a crash of this
+        process anyway, but not from a crash of the machine).
+        """
+        for name in self.arrays:
+            getattr(self,name).flush()
+        self.nstored.flush()
+
+    def close(self):
+        """
+        Flush the arrays and store the final model and the running statistics.
+        """
+        self.flush()
+        self.dump_model()
+        f = file(os.path.join(self.dirname,"running.pic"),"w+")
+        pickle.dump(self.running,f)
+        f.close()
+
+
 class CombinedLogger(Logger):
     def __init__(self, log1, log2, do_radial=False):
         self.do_radial = do_radial
@@ -230,11 +430,13 @@ class CombinedLogger(Logger):
                 self.wrad = np.concatenate([log1.wrad,log2.wrad])
             else:
                 self.wrad_coeff = np.concatenate([log1.wrad_coeff,log2.wrad_coeff])
+        if getattr(log1,"running",None) is not None and getattr(log2,"running",None) is not None:
+            self.running = copy.deepcopy(log1.running)
+            self.running.merge(log2.running)
 
 
-    def statistics(self,model):
+    def statistics(self,model,st=0):
         #... MC.model.blabla ==> model.blabla
-        # TODO
         # st  --  start (cutting out the first MC steps)
         s = st/self.freq
         if s >= self.nf:
@@ -244,56 +446,73 @@ class CombinedLogger(Logger):
             # vec has dimension  nsamples-in-MC x len(profile)
             print "VEC",vec.shape
             assert len(vec.shape) == 2
+            mean = np.mean(vec[s:],0)
+            std = np.std(vec[s:],0)
             for i in range(vec.shape[1]):
-                print i, np.mean(vec[s:,i]),np.std(vec[s:,i])
+                print i, mean[i], std[i]
 
         # Free energy
         print "===== stat v ====="
-        if model.ncosF <= 0:
-            print_vector(self.v,s)
-        else:
-            vec = np.zeros((self.nf,model.dim_v),float)
-            for i in range(len(vec)):
-                vec[i,:] = model.calc_profile(self.v_coeff[i,:],model.v_basis)
-            print_vector(vec,s)
+        print_vector(self.profiles("v",model),s)
+        if model.ncosF > 0:
             print "===== stat v_coeff ====="
             print_vector(self.v_coeff,s)
 
         # Diffusion profile
         print "===== stat w ====="
-        if model.ncosD <= 0:
-            print_vector(self.w,s)
-        else:
-            vec = np.zeros((self.nf,model.dim_w),float)
-            for i in range(len(vec)):
-                vec[i,:] = model.calc_profile(self.w_coeff[i,:],model.w_basis)
-            print_vector(vec,s)
+        print_vector(self.profiles("w",model),s)
+        if model.ncosD > 0:
             print "===== stat w_coeff ====="
             print_vector(self.w_coeff,s)
 
         # Radial diffusion profile
         if self.do_radial:
             print "===== stat wrad ====="
-            if model.ncosDrad <= 0:
-                print_vector(self.wrad,s)
-            else:
-                vec = np.zeros((self.nf,model.dim_wrad),float)
-                for i in range(len(vec)):
-                    vec[i,:] = model.calc_profile(self.wrad_coeff[i,:],model.wrad_basis)
-                print_vector(vec,s)
+            print_vector(self.profiles("wrad",model),s)
+            if model.ncosDrad > 0:
                 print "===== stat wrad_coeff ====="
                 print_vector(self.wrad_coeff,s)
 
 #================================================
 
 def load_logger(filename):
-    """Load an object that I dumped before"""
+    """Load an object that I dumped before, or the directory of a StreamLogger"""
+    if os.path.isdir(filename):
+        return load_stream_logger(filename)
     f = open(filename)
-    import pickle
     pic = pickle.load(f)
     f.close()
     return pic
 
+def load_stream_logger(dirname,mmap_mode="r"):
+    """Open the directory of a StreamLogger as a Logger, with the frames
+    stored so far (also while the run is going on)
+    mmap_mode  --  "r": arrays are memory-mapped and only read when used,
+                   None: read everything now"""
+    f = open(os.path.join(dirname,"logger.json"))
+    meta = json.load(f)
+    f.close()
+    nstored = int(np.load(os.path.join(dirname,"nstored.npy"))[0])
+    logger = Logger.__new__(Logger)
+    logger.freq = meta["freq"]
+    logger.nf = nstored
+    if nstored < meta["nf"]:   # unfinished run, steps done so far
+        logger.nmc = max(nstored-1,0)*logger.freq
+    else:
+        logger.nmc = meta["nmc"]
+    for name in meta["arrays"]:
+        a = np.load(os.path.join(dirname,name+".npy"),mmap_mode=mmap_mode)
+        setattr(logger,str(name),a[:nstored])
+    f = open(os.path.join(dirname,"model.pic"))
+    logger.model = pickle.load(f)
+    f.close()
+    filename = os.path.join(dirname,"running.pic")
+    if os.path.exists(filename):   # only when the run is finished
+        f = open(filename)
+        logger.running = pickle.load(f)
+        f.close()
+    return logger
+
 #================================================
 
 def print_coeffs(f,model,v_coeff=None,w_coeff=None,wrad_coeff=None,timezero=None,final=False):
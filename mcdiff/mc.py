@@ -9,11 +9,12 @@ import numpy as np
 
 from MCState import MCState
 from transitions import Transitions, RadTransitions
-from log import Logger
+from log import Logger, StreamLogger
 
 
-def do_mc_cycles(MC,logger):
+def do_mc_cycles(MC,logger,printfreq=100):
     # MONTE CARLO OPTIMIZATION    # TODO this function can become function of MCState object
+    # printfreq  --  print log-like and acceptance every printfreq MC steps
     print "\n MC-move log-like acc(v) acc(w)"
 
     MC.init_log_like()
@@ -38,7 +39,6 @@ def do_mc_cycles(MC,logger):
                 MC.mcmove_timezero()
 
         # print
-        printfreq = 100  # TODO make this optional
         MC.print_intermediate(imc,printfreq)
         logger.log(imc+1,MC)
  
@@ -50,7 +50,8 @@ def do_mc_cycles(MC,logger):
 def find_parameters(filenames,pbc,model,
       dv,dw,dwrad,D0,dtimezero,temp,temp_end,nmc,nmc_update,seed,outfile, ncosF,ncosD,ncosDrad,
       move_timezero,initfile,k,
-      lmax,reduction): 
+      lmax,reduction,rebin=1,rebinrad=1,logdir=None,logfreq=100,printfreq=100,
+      lazy=False,cache_size=None): 
     print "python program to extract diffusion coefficient and free energy from transition counts"
     print "copyright: Gerhard Hummer (NIH, July 2012)"
     print "adapted by An Ghysels (August 2012)\n"
@@ -66,9 +67,14 @@ def find_parameters(filenames,pbc,model,
 
     # INPUT and INITIALIZATION model/MC
     if MC.do_radial:
-        data = RadTransitions(filenames)
+        data = RadTransitions(filenames,reduction=reduction)
+        if rebin > 1 or rebinrad > 1:
+            data.rebin(rebin,kr=rebinrad)
     else:
-        data = Transitions(filenames,reduction=reduction)
+        # lazy: read a lag time only when it is needed, keep cache_size of them
+        data = Transitions(filenames,reduction=reduction,lazy=lazy,cache_size=cache_size)
+        if rebin > 1:
+            data.rebin(rebin)
     MC.set_model(model,data,ncosF,ncosD,ncosDrad)
 
     # USE INFO from INITFILE
@@ -79,10 +85,14 @@ def find_parameters(filenames,pbc,model,
         MC.print_MC_params(f)
         MC.print_coeffs_laststate(f)
 
-    logger = Logger(MC)
+    # store every logfreq-th step, running statistics of every step
+    if logdir is None:
+        logger = Logger(MC,freq=logfreq)
+    else:
+        logger = StreamLogger(MC,logdir,freq=logfreq)   # frames go to disk during the run
 
     # MONTE CARLO OPTIMIZATION
-    do_mc_cycles(MC,logger)
+    do_mc_cycles(MC,logger,printfreq=printfreq)
 
     # print final results (potential and diffusion coefficient)
     #----------------------------------------------------------
@@ -104,7 +114,10 @@ def find_parameters(filenames,pbc,model,
         f.close()
 
     logger.model = MC.model   # this is not a hard copy
-    logger.dump(picfile)
-    logger.statistics(MC)  #st=1000)
+    if logdir is None:
+        logger.dump(picfile)
+    else:
+        logger.close()   # reopen with load_logger(logdir)
+    logger.statistics(MC)  # running statistics, or st=1000 for the stored frames
     return()
 
@@ -329,20 +329,14 @@ def read_F_D_edges_logger_individualprofiles(logger):
         F = logger.v*logger.model.vunit
         #print "Fshape",F.shape
     else:
-        a = np.zeros((logger.nf,logger.model.dim_v))
-        for i in xrange(len(a)):
-            a[i,:] = logger.model.calc_profile(logger.v_coeff[i,:],logger.model.v_basis)
-        F = a*logger.model.vunit
+        F = logger.profiles("v")*logger.model.vunit
         #print "Fshape",F.shape
 
     if logger.model.ncosD <= 0:
         W = logger.w+logger.model.wunit
         D = np.exp(W)   # in angstrom**2/ps
     else:
-        a = np.zeros((logger.nf,logger.model.dim_w))
-        for i in xrange(len(a)):
-            a[i,:] = logger.model.calc_profile(logger.w_coeff[i,:],logger.model.w_basis)
-        W = a+logger.model.wunit
+        W = logger.profiles("w")+logger.model.wunit
         D = np.exp(W)   # in angstrom**2/ps
 
     edges = logger.model.edges
@@ -353,10 +347,7 @@ def read_Drad_logger_individualprofiles(logger):
         Wrad = logger.wrad+logger.model.wradunit
         Drad = np.exp(Wrad)   # in angstrom**2/ps
     else:
-        a = np.zeros((logger.nf,logger.model.dim_wrad))
-        for i in xrange(len(a)):
-            a[i,:] = logger.model.calc_profile(logger.wrad_coeff[i,:],logger.model.wrad_basis)
-        Wrad = a+logger.model.wradunit
+        Wrad = logger.profiles("wrad")+logger.model.wradunit
         Drad = np.exp(Wrad)   # in angstrom**2/ps
 
     edges = logger.model.edges
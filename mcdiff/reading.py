@@ -149,6 +149,125 @@ def read_transition_cube(filename,dim_rad,dim_trans):
     f.close()
     return transition
 
+def is_binary_transition(filename):
+    """whether the transition file is stored in binary numpy format"""
+    return filename.endswith(".npz")
+
+def read_transition_binary_header(filename):
+    """Read only the header and the shape of the counts from a binary (.npz)
+    transition file, the counts themselves are not loaded"""
+    data = np.load(filename)
+    header = {}
+    for key in data.files:
+        if key == "counts":
+            f = data.zip.open("counts.npy")
+            version = np.lib.format.read_magic(f)
+            if version == (1,0):
+                shape = np.lib.format.read_array_header_1_0(f)[0]
+            else:
+                shape = np.lib.format.read_array_header_2_0(f)[0]
+            f.close()
+        elif key in ["edges","redges"]:
+            header[key] = data[key]
+        elif key in ["count","file"]:
+            header[key] = str(data[key])
+        elif key == "dn":
+            header[key] = int(data[key])
+        else:
+            header[key] = float(data[key])
+    data.close()
+    check_content_header(header)
+    return header,shape
+
+def read_transition_binary(filename):
+    """Read header and counts from a binary (.npz) transition file,
+    as written by write_Tmat_binary"""
+    header,shape = read_transition_binary_header(filename)
+    data = np.load(filename)
+    transition = data["counts"]
+    data.close()
+    return header,transition
+
+def read_transition_file_header(filename):
+    """Read header and shape of the counts from a transition file, binary
+    or text, without reading the counts (text files are only scanned)"""
+    if is_binary_transition(filename):
+        return read_transition_binary_header(filename)
+    header = read_transition_header(filename)
+    if 'redges' in header:
+        dim_rad,dim_trans = guess_dim_transition_cube(filename)
+        return header,(dim_rad,dim_trans,dim_trans)
+    else:
+        dim_trans = guess_dim_transition_square(filename)
+        return header,(dim_trans,dim_trans)
+
+def read_transition_file(filename):
+    """Read header and counts from a transition file, binary or text,
+    square (N x N) or cube (dim_rad x N x N, header has radial edges)"""
+    if is_binary_transition(filename):
+        return read_transition_binary(filename)
+    header = read_transition_header(filename)
+    if 'redges' in header:
+        dim_rad,dim_trans = guess_dim_transition_cube(filename)
+        transition = read_transition_cube(filename,dim_rad,dim_trans)
+    else:
+        dim_trans = guess_dim_transition_square(filename)
+        transition = read_transition_square(filename,dim_trans)
+    return header,transition
+
+def read_transition_cube_sparse(filename,dim_rad,dim_trans):
+    """Read transitions from N1 x N2 x N2 matrix, but only keep the non-zero
+    elements: returns index arrays r, end, start and the integer counts"""
+    list_r = []
+    list_end = []
+    list_start = []
+    list_counts = []
+    f = file(filename)
+    row = 0
+    radbin = 0
+    for line in f:
+        if line.startswith("-"):
+            if row != dim_trans:
+                print "wrong number of entries in ", filename
+                quit()
+            radbin += 1  # I reached next radial point
+            row = 0
+        elif not line.startswith("#"):
+            words = line.split()
+            assert len(words) == dim_trans
+            values = np.array([int(word) for word in words])
+            start = np.flatnonzero(values)
+            if len(start) > 0:
+                list_r.append(np.repeat(radbin,len(start)))
+                list_end.append(np.repeat(row,len(start)))
+                list_start.append(start)
+                list_counts.append(values[start])
+            row += 1
+    f.close()
+    assert radbin == dim_rad
+    if len(list_counts) == 0:
+        empty = np.zeros(0,np.int32)
+        return empty,empty,empty,np.zeros(0,int)
+    r = np.concatenate(list_r).astype(np.int32)
+    end = np.concatenate(list_end).astype(np.int32)
+    start = np.concatenate(list_start).astype(np.int32)
+    counts = np.concatenate(list_counts)
+    return r,end,start,counts
+
+def read_transition_file_sparse(filename):
+    """Read header, shape and non-zero radial transitions (r,end,start,counts)
+    from a radial transition file, binary or text"""
+    if is_binary_transition(filename):
+        header,B = read_transition_binary(filename)
+        assert len(B.shape) == 3
+        r,end,start = np.nonzero(B)
+        counts = B[r,end,start].astype(int)
+        return header,B.shape,(r.astype(np.int32),end.astype(np.int32),start.astype(np.int32),counts)
+    header = read_transition_header(filename)
+    dim_rad,dim_trans = guess_dim_transition_cube(filename)
+    entries = read_transition_cube_sparse(filename,dim_rad,dim_trans)
+    return header,(dim_rad,dim_trans,dim_trans),entries
+
 #=========================== NOT MUCH USED/NOT UPDATED ============================
 
 def guess_dim_transition_linebyline(filename):
@@ -0,0 +1,155 @@
+"""Read CHARMM DCD trajectories without pychm
+Frames are memory-mapped, so that a subset of atoms or frames can be read
+without loading the whole trajectory.
+
+File layout (Fortran unformatted records, each record is
+  int nbytes, data, int nbytes):
+  header   "CORD" + 20 ints ICNTRL (ICNTRL[9] is the time step, a float)
+  title    int ntitle + ntitle lines of 80 characters
+  natom    int natom
+  per frame:
+    unit cell (if ICNTRL[10]): 6 doubles A, gamma, B, beta, alpha, C
+    x, y, z: natom floats each
+    4th dimension (if ICNTRL[11]): natom floats
+"""
+
+import os
+import struct
+import numpy as np
+
+
+AKMA_TIME = 48.8882143060371e-3  # AKMA time unit in ps
+
+
+class DCDReader(object):
+    """Memory-mapped CHARMM DCD trajectory
+
+    Header fields
+    nframes  --  number of frames in the file (from the file size)
+    natom  --  number of atoms
+    istart  --  first step (NPRIV)
+    nsavc  --  frequency (steps) to save coordinates
+    nsteps  --  number of steps (NSTEP)
+    nsavv  --  frequency to save velocities
+    del_t  --  time step in AKMA units, dt  --  time step in ps
+    has_unitcell  --  whether unit cell records are present
+    title  --  list of title lines
+
+    x, y, z  --  memory-mapped arrays nframes x natom (strided views, nothing is read yet)
+    xtl  --  memory-mapped unit cells nframes x 6, or None
+    """
+
+    def __init__(self,filename):
+        self.filename = filename
+        f = open(filename,"rb")
+        try:
+            self.read_header(f)
+        finally:
+            f.close()
+
+        # one record per frame
+        e = self.endian
+        fields = []
+        if self.has_unitcell:
+            fields += [("xtl_start",e+"i4"),("xtl",e+"f8",(6,)),("xtl_end",e+"i4")]
+        for label in ["x","y","z"] + ["w"]*self.has_4dims:
+            fields += [(label+"_start",e+"i4"),(label,e+"f4",(self.natom,)),(label+"_end",e+"i4")]
+        self.frame_dtype = np.dtype(fields)
+
+        size = os.path.getsize(filename) - self.header_size
+        self.nframes = size // self.frame_dtype.itemsize
+        if self.nframes*self.frame_dtype.itemsize != size:
+            print "WARNING: incomplete last frame in %s is skipped" %filename
+        if self.nframes > 0:
+            self.frames = np.memmap(filename,dtype=self.frame_dtype,mode="r",
+                                    offset=self.header_size,shape=(self.nframes,))
+            assert (self.frames["x_start"][:1] == 4*self.natom).all(), "unexpected frame record"
+        else:
+            self.frames = np.zeros(0,self.frame_dtype)
+
+    def read_header(self,f):
+        """Parse header, title and number of atoms"""
+        first = f.read(4)
+        if struct.unpack("<i",first)[0] == 84:
+            e = "<"
+        elif struct.unpack(">i",first)[0] == 84:
+            e = ">"
+        else:
+            raise ValueError("not a DCD file (first record should have 84 bytes): %s"%self.filename)
+        self.endian = e
+
+        def record():
+            nbytes = struct.unpack(e+"i",f.read(4))[0]
+            data = f.read(nbytes)
+            assert struct.unpack(e+"i",f.read(4))[0] == nbytes, "corrupt record"
+            return data
+
+        f.seek(0)
+        data = record()
+        if data[:4] != b"CORD":
+            raise ValueError("not a coordinate DCD file (no CORD): %s"%self.filename)
+        icntrl = struct.unpack(e+"20i",data[4:84])
+        self.icntrl = icntrl
+        self.nfile = icntrl[0]      # frames according to the header
+        self.istart = icntrl[1]
+        self.nsavc = icntrl[2]
+        self.nsteps = icntrl[3]
+        self.nsavv = icntrl[4]
+        self.nfixed = icntrl[8]
+        self.del_t = struct.unpack(e+"f",data[40:44])[0]   # ICNTRL[9] is a float
+        self.dt = self.del_t*AKMA_TIME
+        self.charmm_version = icntrl[19]
+        self.has_unitcell = icntrl[10] != 0 and self.charmm_version != 0
+        self.has_4dims = icntrl[11] != 0 and self.charmm_version != 0
+        if self.nfixed != 0:
+            raise ValueError("DCD files with fixed atoms are not supported: %s"%self.filename)
+
+        data = record()
+        ntitle = struct.unpack(e+"i",data[:4])[0]
+        self.title = [data[4+80*i:4+80*(i+1)].rstrip() for i in range(ntitle)]
+
+        data = record()
+        self.natom = struct.unpack(e+"i",data[:4])[0]
+        self.header_size = f.tell()
+
+    @property
+    def x(self):
+        return self.frames["x"]
+
+    @property
+    def y(self):
+        return self.frames["y"]
+
+    @property
+    def z(self):
+        return self.frames["z"]
+
+    @property
+    def xtl(self):
+        if not self.has_unitcell:
+            return None
+        return self.frames["xtl"]
+
+    def read(self,atoms=None,start=0,stop=None,step=1):
+        """Read a selection into memory
+        atoms  --  list of atom indices, default all atoms
+        start, stop, step  --  frame range, as for a slice
+        Returns dictionary with x, y, z (nframes x natom float arrays)
+        and xtl (nframes x 6, or None), like pychm's get_massive_dump"""
+        frames = self.frames[start:stop:step]
+        data = {}
+        for label in ["x","y","z"]:
+            coor = frames[label]
+            if atoms is not None:
+                coor = coor[:,atoms]
+            data[label] = np.array(coor,float)
+        if self.has_unitcell:
+            data["xtl"] = np.array(frames["xtl"],float)
+        else:
+            data["xtl"] = None
+        return data
+
+
+def read_dcd(filename,atoms=None,start=0,stop=None,step=1):
+    """Read coordinates x, y, z and unit cells xtl of a DCD file, see DCDReader.read"""
+    return DCDReader(filename).read(atoms=atoms,start=start,stop=stop,step=step)
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 
 from histogram import read_coor
 from functionsdiffusion import fit_sqrt_vs_time
+from msd import msd_fft, calc_msd, calc_msd_matrix, collect_dist_hist, condz_msd
 
 
 def plotsettings():
@@ -278,11 +279,14 @@ def analyze_dist_BIS1(list_x,list_y,list_z,dtc):
     allD = np.zeros((nfiles,3),float)
 
     for i in range(nfiles):
-        lagtimes,dist2_xy,dist2_z,dist2_r = collect_dist(list_x[i],list_y[i],list_z[i],dtc)
-        print "file",i,"shape",dist2_xy.shape
-        for it,dist2 in enumerate([dist2_xy,dist2_z,dist2_r]):
-
-            p = np.polyfit(lagtimes,dist2,1)
+        # moments per lag instead of all distances (collect_dist):
+        # fitting all points = fitting the means per lag with weights sqrt(count)
+        dist = collect_dist_hist(list_x[i],list_y[i],list_z[i])
+        lagtimes = dist.shifts*dtc
+        print "file",i,"number of distances",np.sum(dist.count)
+        for it,dist2 in enumerate(dist.msd()):
+
+            p = np.polyfit(lagtimes,dist2,1,w=np.sqrt(dist.count))
             allD[i,it] = p[0]   # a_1 this is in angstrom**2/ps = 1e-20/1e-12 meter**2/second
                                 # = 1e-8 meter**2/second = 1e-4 cm**2/s
             #alllagtimes.append(lagtimes)
@@ -395,10 +399,6 @@ def analyze_dist_condz_traditional(list_x,list_y,list_z,dn1,dtc,zpbc,figname,dn2
     surv  --  whether to use survival probability:
               False or True (divide MSD by P(t))
     """
-    if surv: # True or divide # for survival probability
-        from mcdiff.tools.extract import indices_survived, calc_survival_probability
-        from mcdiff.tools.extract import calc_survival_probability_add
-
     if dn2 is None:
         dn2 = dn1
     assert dn2 >= dn1
@@ -426,30 +426,14 @@ def analyze_dist_condz_traditional(list_x,list_y,list_z,dn1,dtc,zpbc,figname,dn2
         x = list_x[n]   # ntime x natom
         y = list_y[n]
         z = list_z[n]
-        pbccrd_z = z[:,:]-zpbc*np.floor(z[:,:]/zpbc+0.5)
-
-        for k,dn in enumerate(np.arange(dn1,dn2+1,ddn)):
-            dist2_xy,dist2_z,dist2_r = calc_dist_lt(x,y,z,dn)  # (ntime-dn) x natom
-            #print "file,dn",n,dn
-
-            for at in range(natom):
-                # initial z
-                #zinit = z[:-dn,:]-zpbc*np.floor(z[:-dn,:]/zpbc+0.5)  # (ntime-dn) x natom
-                zinit_digi = np.digitize(pbccrd_z[:-dn,at],edges)  # (ntime-dn)
-
-                if surv:
-                    indices = indices_survived(pbccrd_z[:,at],edges,shift=dn)
-                else:
-                    indices = range(len(zinit_digi))
-                for i in indices:
-                    digi = zinit_digi[i]
-                    for j,dist2 in enumerate([dist2_xy,dist2_z,dist2_r]):
-                        count[n,j,digi-1,k]+=1.   # do -1
-                        dz[n,j,digi-1,k]+=dist2[i,at]
-                if surv:
-                    s1,s2,s3 = calc_survival_probability_add(initials[:,k],surviveds[:,k],pbccrd_z[:,at],edges,shift=dn)
-            #if surv:
-            #    survival,initial,survived = calc_survival_probability(z.transpose(),edges,shift=dn)
+        # all atoms and shifts at once, z is digitized once
+        # surv: only displacements that stayed in the bin, see extract.indices_survived
+        c,sums,initial = condz_msd(x,y,z,edges,np.arange(dn1,dn2+1,ddn),zpbc=zpbc,surv=bool(surv))
+        count[n,:,:,:] = c[1:nbins+1,:]   # bin 0 and nbins+1 are outside the box
+        dz[n,:,:,:] = sums[:,1:nbins+1,:]
+        if surv:
+            initials += initial
+            surviveds += c
 
     # FIT  <r^2> = 2 dim D dn dtc
 
@@ -559,7 +543,10 @@ def analyze_dist_condz_traditional_2(list_x,list_y,list_z,dn,dtc,zpbc,figname,nb
     # construct bins - I can play here with resolution
     bins = np.arange(-zpbc/2.,zpbc/2.+0.0001,zpbc/nbins)
     print "bins",bins
-    dz = [[[[] for i in range(nbins)] for i in range(3)] for i in range(nfiles)]
+    # per bin: number, sum and sum of squares of the displacements
+    count = np.zeros((nfiles,3,nbins),float)
+    sum1 = np.zeros((nfiles,3,nbins),float)
+    sum2 = np.zeros((nfiles,3,nbins),float)
     # fill up count and dz arrays
     for n in range(nfiles):
         x = list_x[n]   # ntime x natom
@@ -572,24 +559,18 @@ def analyze_dist_condz_traditional_2(list_x,list_y,list_z,dn,dtc,zpbc,figname,nb
         # (ntime-dn) x natom    initial z
         zinit = z[:-dn,:]-zpbc*np.floor(z[:-dn,:]/zpbc+0.5)
 
-        for at in range(natom):
-            zinit_digi = np.digitize(zinit[:,at],bins)  # (ntime-dn) x natom
-            for i,digi in enumerate(zinit_digi):
-                for j,dist in enumerate([dist_x,dist_y,dist_z]):
-                    dz[n][j][digi-1].append(dist[i,at])
+        zinit_digi = np.digitize(zinit.ravel(),bins)  # all atoms at once
+        for j,dist in enumerate([dist_x,dist_y,dist_z]):
+            d = dist.ravel()
+            count[n,j,:] = np.bincount(zinit_digi,minlength=nbins+2)[1:nbins+1]
+            sum1[n,j,:] = np.bincount(zinit_digi,weights=d,minlength=nbins+2)[1:nbins+1]
+            sum2[n,j,:] = np.bincount(zinit_digi,weights=d**2,minlength=nbins+2)[1:nbins+1]
 
     # FIT  <r^2> = 2 dim D lt
-    allD = np.zeros((nfiles,3,nbins),float)
-    for j in range(3):
-        for n in range(nfiles):
-            for i in range(nbins):
-                a = dz[n][j][i]
-                m = np.mean(a)
-                s = np.std(a)
-                b2 = (a-m)**2
-                M = np.mean(b2)
-                allD[n,j,i] = M/2./lt # a_1 this is in angstrom**2/ps = 1e-20/1e-12 meter**2/second
-                                # = 1e-8 meter**2/second = 1e-4 cm**2/s
+    # variance M = <(a-<a>)**2> = <a**2>-<a>**2
+    M = sum2/count - (sum1/count)**2
+    allD = M/2./lt # a_1 this is in angstrom**2/ps = 1e-20/1e-12 meter**2/second
+                   # = 1e-8 meter**2/second = 1e-4 cm**2/s
 
     print "===== Results ====="
     print "allD",allD.shape
@@ -945,14 +926,8 @@ def calc_dist_1D(x,shifts=None):
     if shifts is None:
         nstep = x.shape[0]  # number of time steps
         shifts = np.arange(nstep)
-    nlags = len(shifts)
-    natom = x.shape[1]  # number of atoms
-    dist2  = np.zeros((nlags,natom),float)
-    # fill up
-    for i,dn in enumerate(shifts):  # dn is shift (lagtime)
-        if dn > 0:
-            diff  = (x[:-dn,:] - x[dn:,:])**2
-            dist2[i,:]  = np.mean(diff,axis=0)   #z/(self.nstep-dn)
+    # all lag times at once with FFT, see msd.py
+    dist2 = msd_fft(x)[np.asarray(shifts)]
     return dist2
 
 def calc_dist(x,y,z,shifts=None,matrix=False):
@@ -963,38 +938,22 @@ def calc_dist(x,y,z,shifts=None,matrix=False):
     if shifts is None:
         nstep = x.shape[0]  # number of time steps
         shifts = np.arange(nstep)
-    nlags = len(shifts)
-    natom = x.shape[1]  # number of atoms
-    weight  = np.zeros((nlags),float)
+    # all lag times at once with FFT, see msd.py
+    shifts = np.asarray(shifts)
+    ntime = x.shape[0]
+    weight = np.where(shifts>0,ntime-shifts,0).astype(float)  # number of time origins
     if not matrix:
-        dist2_xy = np.zeros((nlags,natom,),float)
-        dist2_z  = np.zeros((nlags,natom,),float) 
-        # fill up
-        for i,dn in enumerate(shifts):  # dn is shift (lagtime)
-            if dn > 0:
-                diff2_xy = (x[:-dn,:] - x[dn:,:])**2 + (y[:-dn,:] - y[dn:,:])**2
-                diff2_z  = (z[:-dn,:] - z[dn:,:])**2
-                dist2_xy[i,:] = np.mean(diff2_xy,axis=0)  # xy2/(self.nstep-lt)
-                dist2_z[i,:]  = np.mean(diff2_z,axis=0)   #z/(self.nstep-lt)
-                weight[i] = len(diff2_xy)
-
-        dist2_r = dist2_xy+dist2_z
+        dist2_xy,dist2_z,dist2_r = calc_msd(x,y,z,shifts=shifts)
         return dist2_xy,dist2_z,dist2_r,weight
 
     else:
-        alldist = [np.zeros((nlags,natom),float) for i in range(6)]
-        # fill up
-        for i,dn in enumerate(shifts):  # dn is shift (lagtime)
-            if dn > 0:
-                A = calc_matrixdist_lt(x,y,z,dn)
-                for j in range(6):
-                    alldist[j][i,:] = np.mean(A[j],axis=0)
-                weight[i] = len(A[0])
+        alldist = calc_msd_matrix(x,y,z,shifts=shifts)
         return alldist,weight
 
 def collect_dist(x,y,z,dtc):
     # without averaging over the shifted time origin
     # returns: XXXX
+    # keeps all O(ntime**2*natom) distances, see msd.collect_dist_hist
     lagtimes = []
     dist2_xy = []
     dist2_z = []
@@ -1037,11 +996,6 @@ def calc_dist_folded(x,y,z,unitcells,shifts=None,matrix=False,npt=False):
     assert ntime>1    # not useful if not enough frames
     assert shifts[-1]<ntime
     nlags = len(shifts)
-    if not matrix:
-        dist2_xy = np.zeros((nlags,natom,),float)
-        dist2_z  = np.zeros((nlags,natom,),float)
-    else:
-        alldist = [np.zeros((nlags,natom),float) for i in range(6)]
     weight  = np.zeros((nlags),float)
 
     # construct differences dpos, all of them
@@ -1094,34 +1048,23 @@ def calc_dist_folded(x,y,z,unitcells,shifts=None,matrix=False,npt=False):
         f.close()
         g.close()
 
-    for i,dn in enumerate(shifts):  # dn is shift (lagtime)
-        assert dn >= 0
-        assert dn < ntime # should be the case already
-        if dn > 0:
-            ndiff = ntime-dn
-            diff2 = np.zeros((natom,ndiff,3))
-            #print "pos,dpos,dn,ndiff,diff2",pos.shape,dpos.shape,dn,ndiff,diff2.shape
-            # time origin shifting
-            for st in range(ndiff):
-                end = st+dn
-                diff2[:,st,:] = np.sum(dpos[:,st:end,:],axis=1)
-
-            # average over time origin shifting 
-            if not matrix:
-                dist2_xy[i,:] = np.mean(diff2[:,:,0]**2+diff2[:,:,1]**2,axis=1)
-                dist2_z[i,:] = np.mean(diff2[:,:,2]**2,axis=1)
-            else:
-                for k in range(3):
-                    alldist[k][i,:] = np.mean(diff2[:,:,k]**2,axis=1)
-                alldist[3][i,:] = np.mean(diff2[:,:,0]*diff2[:,:,1],axis=1)
-                alldist[4][i,:] = np.mean(diff2[:,:,0]*diff2[:,:,2],axis=1)
-                alldist[5][i,:] = np.mean(diff2[:,:,1]*diff2[:,:,2],axis=1)
-            weight[i] = ndiff
-
+    # unwrapped positions: prefix sums of the minimum-image steps,
+    # every displacement pos[st+dn]-pos[st] is then sum(dpos[:,st:st+dn,:])
+    upos = np.zeros((natom,ntime,3),float)
+    upos[:,1:,:] = np.cumsum(dpos,axis=1)
+    ux = upos[:,:,0].transpose()   # ntime x natom
+    uy = upos[:,:,1].transpose()
+    uz = upos[:,:,2].transpose()
+
+    # average over time origin shifting, all shifts with FFT
+    shifts = np.asarray(shifts)
+    assert (shifts >= 0).all()
+    weight[:] = np.where(shifts>0,ntime-shifts,0)
     if not matrix:
-        dist2_r = dist2_xy+dist2_z
+        dist2_xy,dist2_z,dist2_r = calc_msd(ux,uy,uz,shifts=shifts)
         return dist2_xy,dist2_z,dist2_r,weight
     else:
+        alldist = calc_msd_matrix(ux,uy,uz,shifts=shifts)
         return alldist,weight
 
 
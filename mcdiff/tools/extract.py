@@ -6,6 +6,8 @@ AG, August 21, 2013"""
 
 import numpy as np
 
+from textio import read_text, iter_text_chunks
+
 
 def count_2D(B,X,Y,Z,edges,redges,shift=1):
     print B.shape
@@ -13,48 +15,45 @@ def count_2D(B,X,Y,Z,edges,redges,shift=1):
     assert B.shape[0] == len(redges)
     assert B.shape[1] == len(edges)+1
     assert B.shape[2] == len(edges)+1
-    
-    #Nz = len(edges)-1
-    #Nr = len(redges)-1
-    digitized = np.digitize(Z,edges)
-
-    zstart = digitized[:-shift]
-    zend = digitized[shift:]
-    dX = X[shift:] - X[:-shift]
-    dY = Y[shift:] - Y[:-shift]
-    dR = np.sqrt(dX**2+dY**2)
-    dr = np.digitize(dR,redges)
-
-    #print max(digitized)
-    #print max(dr)
-
-    assert len(dr) == len(zstart)
-    assert len(dr) == len(zend)
-
-#    i=0
-    for start,end,r in zip(zstart,zend,dr):
-        B[r-1,end,start] += 1 
-
-#        if r > 10:
-        #nbins = len(edges)-1
-        #D = min( abs(end-start), abs(end-start-nbins), abs(end-start+nbins) )
-        #if D >= 5:
-#           print "step", i
-#           print shift, start, end
-           #print stop
-#        i+=1
+    B += transition_cubes(X,Y,Z,edges,redges,[shift])[0]
+    return B
 
+def count_transitions_cube(zdigitized,X,Y,nb,redges,shifts):
+    """Count the transitions (z-bin start -> z-bin end, radial distance) for
+    several lag shifts at once
+    zdigitized  --  z-bin index of each frame, in 0..nb-1, array ntime or ntime x natom
+    X, Y  --  coordinates with the same shape
+    nb  --  number of z-bin indices
+    redges  --  radial bin edges [0,dr,...], the last radial bin has all
+                displacements beyond redges[-1]
+    Returns int array len(shifts) x len(redges) x nb x nb, with B[k,r,end,start]"""
+    nr = len(redges)
+    redges2 = np.asarray(redges,float)**2
+    ntime = len(zdigitized)
+    B = np.zeros((len(shifts),nr,nb,nb),int)
+    for k,shift in enumerate(shifts):
+        assert shift > 0 and shift < ntime
+        dR2 = (X[shift:]-X[:-shift])**2 + (Y[shift:]-Y[:-shift])**2
+        r = np.digitize(np.ravel(dR2),redges2)-1   # compare squares, no sqrt needed
+        flat = (r*nb + np.ravel(zdigitized[shift:]))*nb + np.ravel(zdigitized[:-shift])
+        B[k] = np.bincount(flat,minlength=nr*nb*nb).reshape((nr,nb,nb))
     return B
 
+def transition_cubes(X,Y,Z,edges,redges,shifts):
+    """Radial transition cubes for several lag shifts, in one pass over the coordinates
+    X, Y, Z  --  coordinates, arrays ntime or ntime x natom
+    edges  --  z-bin edges, transitions are counted in len(edges)+1 z-bins
+    redges  --  radial bin edges, len(redges) radial bins
+    Returns int array len(shifts) x len(redges) x (len(edges)+1) x (len(edges)+1)"""
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+    zdigitized = np.digitize(np.ravel(Z),edges).reshape(np.shape(Z))
+    return count_transitions_cube(zdigitized,X,Y,len(edges)+1,redges,shifts)
+
 
 def read_traj0000(filename):
-    f = file(filename)
-    data = []
-    for line in f:
-      if not line.startswith("#"):
-      ####  data.append(float(line))
-        data.append(float(line.split()[0]))
-    return np.array(data)
+    # first column
+    return read_text(filename,columns=0)
 
 
 def write_Tmat_square(A,filename,lt,count,edges=None,dt=None,dn=None):
@@ -107,66 +106,334 @@ def write_Tmat_cube(B,filename,lt,count,edges=None,redges=None,dt=None,dn=None):
       print >> f, "-"
     f.close()
 
+def write_Tmat_binary(A,filename,lt,count,edges=None,redges=None,dt=None,dn=None):
+    """Write the transition matrix (N x N) or cube (dim_rad x N x N) counts
+    in binary numpy format (.npz), with the same header as the text formats
+    lt  --  lag time in ps
+    edges  --  bin edges
+    redges  --  bin edges of radial bins
+    filename must end with .npz, by which the readers recognize binary files
+    """
+    if not filename.endswith(".npz"):
+        raise ValueError("binary transition file should have extension .npz: %s"%filename)
+    header = {"lt":lt, "count":count}
+    if dt is not None:
+        header["dt"] = dt
+    if dn is not None:
+        header["dn"] = dn
+    if edges is not None:
+        header["edges"] = edges
+    if redges is not None:
+        header["redges"] = redges
+    f = file(filename,"wb")   # file object: np.savez does not add an extension
+    np.savez(f,counts=np.asarray(A,int),**header)
+    f.close()
+
+def write_Tmat_file(A,filename,lt,count,edges=None,redges=None,dt=None,dn=None,binary=False):
+    """Write transition counts in the format that fits: binary,
+    square (N x N) or cube (dim_rad x N x N)
+    Returns the filename, to which .npz is added for binary if missing"""
+    if binary:
+        if not filename.endswith(".npz"):
+            filename += ".npz"
+        write_Tmat_binary(A,filename,lt,count,edges=edges,redges=redges,dt=dt,dn=dn)
+    elif len(A.shape) == 2:
+        write_Tmat_square(A,filename,lt,count,edges=edges,dt=dt,dn=dn)
+    elif len(A.shape) == 3:
+        write_Tmat_cube(A,filename,lt,count,edges=edges,redges=redges,dt=dt,dn=dn)
+    else: raise ValueError("transition counts do not have expected dimension (2 or 3): %i"
+                 %len(A.shape))
+    return filename
+
+
+def count_transitions(digitized,nb,shifts):
+    """Count the transitions start->end for several lag shifts at once
+    digitized  --  bin index of each frame, in 0..nb-1, array ntime or ntime x natom
+    nb  --  number of bin indices
+    shifts  --  list of lag shifts (number of frames)
+    Returns int array len(shifts) x nb x nb, with A[k,end,start]
+    the number of transitions start->end after shifts[k] frames, all atoms added"""
+    digitized = np.asarray(digitized)
+    ntime = len(digitized)
+    A = np.zeros((len(shifts),nb,nb),int)
+    for k,shift in enumerate(shifts):
+        assert shift > 0 and shift < ntime
+        # flat index end*nb+start of every (time origin, atom) pair
+        flat = digitized[shift:]*nb + digitized[:-shift]
+        A[k] = np.bincount(flat.ravel(),minlength=nb*nb).reshape((nb,nb))
+    return A
+
+def transition_matrices(x,edges,shifts):
+    """Transition matrices for several lag shifts, in one pass over the coordinates
+    x  --  coordinates, array ntime or ntime x natom
+    edges  --  bin edges, transitions are counted in len(edges)+1 bins
+               (first and last bin are below/above the edges)
+    Returns int array len(shifts) x (len(edges)+1) x (len(edges)+1), A[k,end,start]"""
+    digitized = np.digitize(np.ravel(x),edges).reshape(np.shape(x))
+    return count_transitions(digitized,len(edges)+1,shifts)
 
 def transition_matrix_add1(A,x,edges,shift=1):
     assert len(x.shape) == 1
     assert shift < len(x)
     assert len(A) == len(edges)+1
-    digitized = np.digitize(x,edges)
-    #if False:  # pbc
-    #  for i in digitized:
-    #    assert i > 0
-    #    assert i < len(edges)
-    #print "min,max,A.shape"
-    #print min(digitized),max(digitized),A.shape
-    #print "min,max",
-    #print min(x),max(x)
     # periodic boundary conditions: just checking
     print "check boundary", sum(A[0,:]), sum(A[-1,:]), sum(A[:,0]), sum(A[:,-1])
-    #i = 0
-    for start,end in zip(digitized[:-shift],digitized[shift:]):
-        #nbins = len(edges)-1
-        #D = min( abs(end-start), abs(end-start-nbins), abs(end-start+nbins) )
-        #if D >= 5:
-        #   print "step", i
-        #   print shift, start, end
-        #   #print stop
-        A[end,start]+=1
-        #i += 1
+    A += transition_matrices(x,edges,[shift])[0]
     return A
 
+def fractional_in_box(x,zpbc):
+    """Coordinates scaled by the box length of each frame and put back
+    in the box [-0.5,0.5[ (the periodic image closest to the origin)
+    x  --  coordinates, array ntime or ntime x natom
+    zpbc  --  box length, number or array ntime"""
+    x = np.asarray(x,float)
+    zpbc = (np.asarray(zpbc,float)*np.ones(len(x))).reshape((-1,)+(1,)*(x.ndim-1))
+    frac = x/zpbc
+    frac -= np.floor(frac+0.5)
+    return frac
+
+def digitize_npt(x,zpbc,nbins,wrap=False):
+    """Bin index of coordinates in bins that scale with the fluctuating box,
+    the same as np.digitize(x[i],(np.arange(nbins+1)-nbins/2.)*zpbc[i]/nbins)
+    for every frame i, but computed for all frames and atoms at once
+    x  --  coordinates, array ntime or ntime x natom
+    zpbc  --  box length of each frame, array ntime
+    wrap  --  put x back in the box first (fractional_in_box), as
+              TransitionCounter does with zpbc (mcdiff count --zpbc);
+              without wrap, x should already be in the box [-zpbc/2,zpbc/2[,
+              coordinates outside (unwrapped) go to the bins 0 and nbins+1
+    Returns bin index in 0..nbins+1 (0 and nbins+1 are outside the box)"""
+    if wrap:
+        frac = fractional_in_box(x,zpbc)
+    else:
+        x = np.asarray(x)
+        frac = x/np.asarray(zpbc,float).reshape((-1,)+(1,)*(x.ndim-1))   # box is [-0.5,0.5[
+    digitized = np.floor((frac+0.5)*nbins).astype(int)+1
+    return np.clip(digitized,0,nbins+1)
+
+def transition_matrices_npt(x,zpbc,nbins,shifts,wrap=False):
+    """Transition matrices for several lag shifts of an NPT trajectory,
+    with nbins bins that scale with the box length zpbc of each frame
+    x  --  coordinates, array ntime or ntime x natom
+    wrap  --  put x back in the box first, see digitize_npt
+    Returns int array len(shifts) x (nbins+2) x (nbins+2), A[k,end,start]"""
+    return count_transitions(digitize_npt(x,zpbc,nbins,wrap=wrap),nbins+2,shifts)
+
+def transition_cubes_npt(X,Y,Z,zpbc,nbins,redges,shifts,wrap=False):
+    """Radial transition cubes for several lag shifts of an NPT trajectory,
+    z-bins scale with the box length zpbc of each frame, see transition_cubes
+    wrap  --  put Z back in the box first, see digitize_npt"""
+    zdigitized = digitize_npt(Z,zpbc,nbins,wrap=wrap)
+    return count_transitions_cube(zdigitized,np.asarray(X),np.asarray(Y),nbins+2,redges,shifts)
+
 def transition_matrix_add1_npt(A,x,zpbc,nbins,shift=1):
     assert len(x.shape) == 1
     assert shift < len(x)
     assert len(x) == len(zpbc)
     assert len(A) == nbins+2
-    arr = np.arange(nbins+1)-nbins/2.
-    digitized = np.zeros(x.shape)
-    for i in xrange(len(digitized)):
-        digitized[i] = np.digitize([x[i]],(arr*zpbc[i]/nbins))
-    #digitized = np.digitize(x,edges)
-    #if False:  # pbc
-    #  for i in digitized:
-    #    assert i > 0
-    #    assert i < len(edges)
-    #print "min,max,A.shape"
-    #print min(digitized),max(digitized),A.shape
-    #print "min,max",
-    #print min(x),max(x)
     # periodic boundary conditions: just checking
     print "check boundary", sum(A[0,:]), sum(A[-1,:]), sum(A[:,0]), sum(A[:,-1])
-    #i = 0
-    for start,end in zip(digitized[:-shift],digitized[shift:]):
-        #nbins = len(edges)-1
-        #D = min( abs(end-start), abs(end-start-nbins), abs(end-start+nbins) )
-        #if D >= 5:
-        #   print "step", i
-        #   print shift, start, end
-        #   #print stop
-        A[end,start]+=1
-        #i += 1
+    A += transition_matrices_npt(x,zpbc,nbins,[shift])[0]
     return A
 
+#------------------------
+# STREAMING
+#------------------------
+
+def read_traj_chunks(filename,chunksize,columns=None):
+    """Read a coordinate text file in chunks of chunksize frames,
+    comment lines starting with # are skipped
+    columns  --  column indices to keep, default all columns
+    Yields float arrays chunksize x ncolumns (the last chunk may be shorter)"""
+    return iter_text_chunks(filename,chunksize,columns=columns)
+
+class TransitionCounter(object):
+    """Accumulate transition counts for several lag shifts from a trajectory
+    that is fed in chunks of frames, so that it never needs to be in memory.
+    The last max(shifts) frames of a chunk are kept, such that transitions
+    across chunk boundaries are counted, each transition exactly once.
+    Counts are in self.counts, A[k,end,start] or B[k,r,end,start] (radial),
+    with len(edges)+1 z-bins (first and last bin are below/above the edges).
+    With box lengths zpbc (NPT), z is scaled by the box length of each frame
+    and wrapped in the periodic box, and edges are in units of the box length,
+    e.g. np.linspace(-0.5,0.5,nbins+1)."""
+
+    def __init__(self,edges,shifts,redges=None):
+        self.edges = np.asarray(edges,float)
+        self.shifts = [int(shift) for shift in shifts]
+        assert min(self.shifts) > 0
+        self.maxshift = max(self.shifts)
+        self.redges = redges
+        self.nb = len(self.edges)+1
+        if redges is None:
+            self.counts = np.zeros((len(self.shifts),self.nb,self.nb),int)
+        else:
+            self.redges = np.asarray(redges,float)
+            self.counts = np.zeros((len(self.shifts),len(self.redges),self.nb,self.nb),int)
+        self.tail = None     # last frames of the previous chunks
+        self.nframes = 0     # number of frames seen
+        self.periodic = False
+        self.zpbc_sum = 0.   # to get the average box length
+
+    def digitize(self,z,zpbc=None):
+        z = np.asarray(z,float)
+        if zpbc is None:
+            assert not self.periodic
+            return np.digitize(np.ravel(z),self.edges).reshape(z.shape)
+        assert self.periodic or self.nframes == 0
+        self.periodic = True
+        frac = fractional_in_box(z,zpbc)   # same convention as digitize_npt(wrap=True)
+        return np.digitize(np.ravel(frac),self.edges).reshape(z.shape)
+
+    def get_data(self,z,x,y,zpbc):
+        zdigitized = self.digitize(z,zpbc)
+        if self.redges is None:
+            return [zdigitized]
+        assert x is not None and y is not None
+        data = [zdigitized,np.asarray(x,float),np.asarray(y,float)]
+        assert data[1].shape == zdigitized.shape and data[2].shape == zdigitized.shape
+        return data
+
+    def skip(self,z,x=None,y=None,zpbc=None):
+        """Feed frames that are not counted themselves, but that are
+        the start of transitions into the next chunk, e.g. the frames just
+        before a chunk of the trajectory that is counted by another process"""
+        self.tail = [d[-self.maxshift:].copy() for d in self.get_data(z,x,y,zpbc)]
+
+    def add(self,z,x=None,y=None,zpbc=None):
+        """Add a chunk of frames
+        z  --  z-coordinates, array ntime or ntime x natom
+        x, y  --  coordinates with the same shape, only for radial counts
+        zpbc  --  box length, number or array ntime"""
+        nb = self.nb
+        data = self.get_data(z,x,y,zpbc)
+        nnew = len(data[0])
+        if self.tail is None:
+            ntail = 0
+        else:
+            ntail = len(self.tail[0])
+            data = [np.concatenate((t,d)) for t,d in zip(self.tail,data)]
+        ntime = len(data[0])
+
+        redges2 = None
+        if self.redges is not None:
+            redges2 = self.redges**2
+            nr = len(self.redges)
+        for k,shift in enumerate(self.shifts):
+            # only transitions that end in the new frames
+            first = max(ntail,shift)
+            if first >= ntime:
+                continue
+            end = data[0][first:]
+            start = data[0][first-shift:ntime-shift]
+            if self.redges is None:
+                flat = end*nb + start
+                self.counts[k] += np.bincount(flat.ravel(),minlength=nb*nb).reshape((nb,nb))
+            else:
+                X = data[1]
+                Y = data[2]
+                dR2 = (X[first:]-X[first-shift:ntime-shift])**2 + (Y[first:]-Y[first-shift:ntime-shift])**2
+                r = np.digitize(np.ravel(dR2),redges2)-1
+                flat = (r*nb + np.ravel(end))*nb + np.ravel(start)
+                self.counts[k] += np.bincount(flat,minlength=nr*nb*nb).reshape((nr,nb,nb))
+
+        self.tail = [d[-self.maxshift:].copy() for d in data]
+        self.nframes += nnew
+        if zpbc is not None:
+            self.zpbc_sum += np.sum(np.asarray(zpbc,float)*np.ones(nnew))
+
+    def merge(self,other):
+        """Add the counts of another counter with the same bins and shifts,
+        e.g. from another part of the trajectory or other atoms"""
+        assert self.shifts == other.shifts
+        assert self.counts.shape == other.counts.shape
+        assert (self.edges == other.edges).all()
+        self.counts += other.counts
+        self.nframes += other.nframes
+        self.periodic = self.periodic or other.periodic
+        self.zpbc_sum += other.zpbc_sum
+
+    def get_edges(self):
+        """Bin edges in coordinate units, for NPT scaled with the average box length"""
+        if self.periodic:
+            return self.edges*self.zpbc_sum/self.nframes
+        return self.edges
+
+    def get_counts(self,count="cut"):
+        """Transition counts in the convention of the output files
+        count  --  "cut": leave out the bins below/above the edges,
+                   "pbc": add the bins below the edges to the last bin, as RunData,
+                          when wrapped in the periodic box: the bins inside the box
+                   "raw": all len(edges)+1 bins"""
+        A = self.counts.copy()
+        if count == "raw":
+            return A
+        elif count == "cut" or (count == "pbc" and self.periodic):
+            return A[...,1:-1,1:-1]
+        elif count == "pbc":
+            A[...,-1,1:] += A[...,0,1:]
+            A[...,1:,-1] += A[...,1:,0]
+            A[...,-1,-1] += A[...,0,0]
+            return A[...,1:,1:]
+        else: raise ValueError("count should be raw, cut or pbc, found: %s"%count)
+
+    def write(self,basename,dt,count="cut",binary=False):
+        """Write one transition matrix (or cube) file per lag shift,
+        named basename.shift.count.dat, or basename.format(shift)
+        if basename is a template with {}
+        dt  --  time between frames in ps
+        count  --  "cut" or "pbc", the counts the transition readers accept,
+                   "pbc" only for coordinates wrapped in the box (zpbc given)"""
+        if count not in ["pbc","cut"]:
+            raise ValueError("count should be cut or pbc to write files, found: %s"%count)
+        if count == "pbc" and not self.periodic:
+            # the folded below/above bins are not a periodic bin and the bins do not match the edges
+            raise ValueError("count pbc needs the box length (zpbc), use count cut for fixed edges")
+        if count == "cut" or self.periodic:
+            edges = self.get_edges()
+        else:
+            edges = None    # the bins do not match the edges
+        counts = self.get_counts(count)
+        filenames = []
+        for k,shift in enumerate(self.shifts):
+            if "{}" in basename:
+                filename = basename.format(shift)
+            else:
+                filename = basename+"."+str(shift)+"."+count+".dat"
+            filename = write_Tmat_file(counts[k],filename,shift*dt,count,edges=edges,
+                     redges=self.redges,dt=dt,dn=shift,binary=binary)   # binary: .npz added
+            filenames.append(filename)
+        return filenames
+
+def stream_transitions(chunks,edges,shifts,redges=None):
+    """Count transitions for several lag shifts from an iterable of chunks
+    chunks  --  arrays ntime_chunk (x natom) with z-coordinates,
+                or tuples (x,y,z) of such arrays if radial edges are given
+    Returns a TransitionCounter"""
+    counter = TransitionCounter(edges,shifts,redges=redges)
+    for chunk in chunks:
+        if redges is None:
+            counter.add(chunk)
+        else:
+            x,y,z = chunk
+            counter.add(z,x=x,y=y)
+    return counter
+
+def stream_transitions_file(filename,edges,shifts,chunksize=100000,redges=None,columns=None):
+    """Count transitions for several lag shifts from a coordinate text file,
+    reading chunksize frames at a time
+    columns  --  column of z (default 0), or columns of x,y,z (default 0,1,2)
+                 if radial edges are given
+    Returns a TransitionCounter"""
+    if redges is None:
+        if columns is None: columns = 0
+        chunks = (data[:,columns] for data in read_traj_chunks(filename,chunksize))
+    else:
+        if columns is None: columns = [0,1,2]
+        chunks = (data[:,columns].transpose() for data in read_traj_chunks(filename,chunksize))
+    return stream_transitions(chunks,edges,shifts,redges=redges)
+
+
 
 def transition_matrix_add2(A,x,edges,shift=1):
     assert len(x.shape) == 1
@@ -191,6 +458,63 @@ def transition_matrix_add2(A,x,edges,shift=1):
     #    write_Tmat_square(A[1:-1,1:-1],filename+"."+str(shift)+".pbc.dat")
 
 
+def residence_end(digitized):
+    """Last frame of the bin residence (run of equal bin indices) of every frame,
+    frame i stays in its bin during the lag shift dn if residence_end[i] >= i+dn
+    digitized  --  bin index of each frame, array ntime or ntime x natom
+    Returns int array with the same shape"""
+    digitized = np.asarray(digitized)
+    ntime = len(digitized)
+    frames = np.arange(ntime).reshape((-1,)+(1,)*(digitized.ndim-1))
+    last = np.ones(digitized.shape,bool)   # last frame of a residence
+    last[:-1] = digitized[1:] != digitized[:-1]
+    index = np.where(last,frames,ntime)
+    # first last-frame at or after each frame
+    return np.minimum.accumulate(index[::-1],axis=0)[::-1]
+
+def count_survival(digitized,nb,shifts):
+    """Count the frames that start in a bin and stay in that bin during the lag,
+    for all bins and lag shifts in one pass over the bin residences
+    digitized  --  bin index of each frame, in 0..nb-1, array ntime or ntime x natom
+    nb  --  number of bin indices
+    shifts  --  lag shifts (number of frames)
+    Returns initial, survived, int arrays nb x len(shifts)
+      initial[b,k]  --  number of frames i < ntime-shift in bin b
+      survived[b,k]  --  number of those that stay in b from i to i+shift"""
+    digitized = np.asarray(digitized)
+    shifts = np.asarray(shifts,int)
+    ntime = len(digitized)
+    maxshift = shifts.max()
+    assert shifts.min() > 0 and maxshift < ntime
+    frames = np.arange(ntime).reshape((-1,)+(1,)*(digitized.ndim-1))
+    # remaining residence time in the bin, longer than maxshift does not matter
+    remain = np.minimum(residence_end(digitized)-frames,maxshift)
+    hist = np.bincount((digitized*(maxshift+1)+remain).ravel(),
+                       minlength=nb*(maxshift+1)).reshape((nb,maxshift+1))
+    # survived[b,dn] = number with remain >= dn (then also i+dn < ntime)
+    atleast = np.cumsum(hist[:,::-1],axis=1)[:,::-1]
+    survived = atleast[:,shifts]
+    # initial[b,dn] = total in b minus those in the last dn frames
+    last = digitized[ntime-maxshift:][::-1]     # last frames, backwards
+    lasthist = np.bincount((last*maxshift+frames[:maxshift]).ravel(),
+                       minlength=nb*maxshift).reshape((nb,maxshift))
+    inlast = np.cumsum(lasthist,axis=1)     # in the last dn frames, dn=1..maxshift
+    total = np.bincount(digitized.ravel(),minlength=nb)
+    initial = total[:,None] - inlast[:,shifts-1]
+    return initial,survived
+
+def survival_probabilities(x,edges,shifts):
+    """Survival probability in each bin for several lag shifts, without counting
+    particles that left a bin during the lag time, see count_survival
+    x  --  coordinates, array ntime or ntime x natom
+    Returns survival, initial, survived, arrays (len(edges)+1) x len(shifts)"""
+    x = np.asarray(x)
+    digitized = np.digitize(x.ravel(),edges).reshape(x.shape)
+    initial,survived = count_survival(digitized,len(edges)+1,shifts)
+    initial = initial.astype(float)
+    survived = survived.astype(float)
+    return survived/initial, initial, survived
+
 def calc_survival_probability(list_coor,edges,shift=1):
     """Calculate the survival probability
     without counting particles that left a bin during the lag time"""
@@ -206,13 +530,9 @@ def calc_survival_probability_add(initial,survived,x,edges,shift=1):
     assert len(initial)==len(survived)
     assert len(initial)==len(edges)+1
 
-    digitized = np.digitize(x,edges)
-    for i in range(len(digitized)-shift):
-        start = digitized[i]
-        same = (digitized[i:i+shift+1]==start).all()
-        #print start,same,int(same),digitized[i:i+shift+1]
-        initial[start] += 1.    # should be float
-        survived[start] += float(same)   # should be float
+    prob,init,surv = survival_probabilities(x,edges,[shift])
+    initial += init[:,0]    # should be float
+    survived += surv[:,0]   # should be float
 
     return survived/initial, initial, survived
 
@@ -221,14 +541,11 @@ def indices_survived(x,edges,shift=1):
     assert len(x.shape) == 1
     assert shift < len(x)
 
-    indices = []
     digitized = np.digitize(x,edges)
-    for i in range(len(digitized)-shift):
-        start = digitized[i]
-        same = (digitized[i:i+shift+1]==start).all()
-        if same:
-            indices.append(i)
-    return indices
+    end = residence_end(digitized)
+    ndiff = len(digitized)-shift
+    indices = np.nonzero(end[:ndiff] >= np.arange(ndiff)+shift)[0]
+    return indices.tolist()
 
 #=========== OLDER =========
 def write_Tmat_linebyline(A,filename,edges=None):
@@ -3,8 +3,9 @@ AG, July 15, 2012"""
 
 import numpy as np
 import matplotlib.pyplot as plt
-import pickle
-import struct
+import os
+
+from msd import msd_fft, autocorr_fft
 
 
 def plotsettings():
@@ -32,13 +33,14 @@ class RunData(object):
         self.startedout = False
         self.distdone = False
         
-    def read_charmm_traj(self,filename,dtc=None):
-        """Read rom CHARMM trajectory"""
-        import pychm.future.io.charmm as iocharmm
-        import pychm.scripts.getprop as getprop
-        taco = iocharmm.open_dcd(filename)
+    def read_charmm_traj(self,filename,dtc=None,atoms=None,start=0,stop=None):
+        """Read rom CHARMM trajectory
+        atoms  --  only read these atom indices, default all
+        start, stop  --  only read this frame range"""
+        from dcd import DCDReader
+        taco = DCDReader(filename)
 
-        data = taco.get_massive_dump()
+        data = taco.read(atoms=atoms,start=start,stop=stop)
 
         #from pprint import pprint
         #pprint (vars(taco))
@@ -60,8 +62,7 @@ class RunData(object):
 
             self.nstep = taco.nsteps
             self.nsavv = taco.nsavv  # freq to save velocities
-            self.del_t = taco.del_t  # TODO  WHATT??? Timestep in AKMA-units. Bit-copy from the 32-bit real number
-            self.del_t = struct.unpack('f', struct.pack('i', taco.del_t))[0] * RunData.akma_time  # should be identical to self.dt
+            self.del_t = taco.dt  # Timestep in ps (DCD header has AKMA-units), should be identical to self.dt
             # nprint = freq to print energy      500
             # iprfrq = freq to give statistics  5000
             # ntrfrq = freq to remove trans/rot  100
@@ -98,7 +99,99 @@ class RunData(object):
         print "Added: %15i Total: %15i CHARMM: nsteps/nsavc = %i/%i=%i" %(x.shape[0],
                 self.nstep,taco.nsteps,taco.nsavc,taco.nsteps/taco.nsavc)
 
+    def read_charmm_trajs(self,filenames,dtc=None,atoms=None,memmap_dir=None,nproc=1):
+        """Read and concatenate several CHARMM trajectories in two passes:
+        first the frame counts from all headers, then fill the arrays
+        that are allocated only once
+        atoms  --  only read these atom indices, default all
+        memmap_dir  --  put the arrays in .npy files in this (scratch) directory,
+                        memory-mapped instead of in memory
+        nproc  --  read the files concurrently (only with memmap_dir)"""
+        from dcd import DCDReader
+        assert not self.started, "read_charmm_trajs starts a new trajectory"
+        tacos = [DCDReader(filename) for filename in filenames]
+        taco = tacos[0]
+        for other in tacos[1:]:
+            assert other.natom == taco.natom
+            assert other.nsavc == taco.nsavc
+            assert other.nsavv == taco.nsavv
+            assert other.has_unitcell == taco.has_unitcell
+        nframes = [other.nframes for other in tacos]
+        offsets = np.cumsum([0]+nframes)
+        ntime = offsets[-1]
+        natom = taco.natom if atoms is None else len(atoms)
+
+        # allocate once
+        shapes = {"x":(ntime,natom),"y":(ntime,natom),"z":(ntime,natom),"xtl":(ntime,6)}
+        if memmap_dir is not None:
+            paths = dict([(label,os.path.join(memmap_dir,"traj.%s.npy"%label)) for label in shapes])
+            for label in shapes:
+                self.__dict__[label] = np.lib.format.open_memmap(paths[label],mode="w+",
+                                                   dtype=float,shape=shapes[label])
+        else:
+            for label in shapes:
+                self.__dict__[label] = np.zeros(shapes[label],float)
+
+        # fill in place
+        tasks = [(filename,atoms,offsets[i]) for i,filename in enumerate(filenames)]
+        if memmap_dir is not None and nproc > 1:
+            for label in shapes:
+                self.__dict__[label].flush()
+            import multiprocessing
+            pool = multiprocessing.Pool(nproc)
+            pool.map(fill_from_dcd,[task+(paths,) for task in tasks])
+            pool.close()
+            pool.join()
+            for label in shapes:
+                self.__dict__[label] = np.load(paths[label],mmap_mode="r+")
+        else:
+            arrays = dict([(label,self.__dict__[label]) for label in shapes])
+            for task in tasks:
+                fill_from_dcd(task+(arrays,))
+                print "read:", task[0]
+
+        self.started = True
+        self.size = natom
+        self.acdone = [False]*self.size
+        self.nsavv = taco.nsavv
+        self.del_t = taco.dt  # Timestep in ps, should be identical to self.dt
+        self.dt = 0.001   # ps  # make sure to be float!!!                # TODO hard coded
+        if dtc == None:
+            self.dtc = self.dt * taco.nsavc
+            self.nsavc = taco.nsavc  # freq to save coords
+        else:
+            self.dtc = float(dtc)
+            self.nsavc = float(dtc)/self.dt
+
+        self.xpbc = self.xtl[:,0]
+        self.ypbc = self.xtl[:,2]
+        self.zpbc = self.xtl[:,-1]
+        self.nstep = self.x.shape[0]
+        print "Total: %15i frames from %i files" %(self.nstep,len(filenames))
+
+    def save(self,dirname):
+        """Store in a directory: every array (coordinates, box, dist_*, ...)
+        as a separate .npy file and the other settings in rundata.json,
+        reopen with load_rundata"""
+        import json
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        meta = {}
+        arrays = []
+        for attr,value in self.__dict__.items():
+            if isinstance(value,np.ndarray):
+                np.save(os.path.join(dirname,attr+".npy"),value)
+                arrays.append(attr)
+            else:
+                meta[attr] = to_json(value)
+        meta["arrays"] = sorted(arrays)
+        f = open(os.path.join(dirname,"rundata.json"),"w")
+        json.dump(meta,f,indent=1,sort_keys=True)
+        f.close()
+        print "stored:", dirname
+
     def read_charmm_out(self,filename):
+        import pychm.scripts.getprop as getprop
 
         outDict = getprop.getProp(open(filename),'dynatime','dynaener',
                 'dynapresse','dynapressi','dynatemp')  #'averener','dynavdw')
@@ -187,31 +280,10 @@ class RunData(object):
 
 
     def smooth_traj_manually(self):
+        """Unwrap the coordinates in place, all atoms at once, see unwrap_pbc"""
         for i,cor in enumerate([self.x, self.y, self.z]):
             pbc = [self.xpbc, self.ypbc, self.zpbc][i]
-            for at in range(self.size): #[0,]:  #xrange(self.size):    # HARDCODED TODO
-                diff = cor[1:,at]-cor[:-1,at]
-                plusmask = diff > (pbc[:-1]*0.75)
-                minmask = diff < -(pbc[:-1]*0.75)
-                plusmask = plusmask.tolist()
-                minmask = minmask.tolist()
-
-                start = -1
-                while True:
-                    try:
-                        start = start + plusmask[start+1:].index(True) +1
-                        cor[start+1:,at] -= pbc[start]  # shift
-                        #print start, plusmask[start]
-                    except ValueError:
-                        break
-                start = -1
-                while True:
-                    try:
-                        start = start + minmask[start+1:].index(True) +1
-                        cor[start+1:,at] += pbc[start]  # shift
-                        #print start, minmask[start]
-                    except ValueError:
-                        break
+            unwrap_pbc(cor,pbc,threshold=0.75)
 
 
     def preliminary_plots(self,outdir):
@@ -270,19 +342,18 @@ class RunData(object):
 
     def calc_dist(self):   # kind of oversampling
         if self.distdone == True: return
-        alldist_xy = np.zeros((self.nstep,self.size),float)
+        alldist_xy = msd_fft(self.x) + msd_fft(self.y)   # all lag times with FFT
         alldist_z  = np.zeros((self.nstep,self.size),float)
 
         for lt in range(1,self.nstep):  # lt is lagtime
             # fill in alldist[i]
-            diff_xy = (self.x[:-lt,:] - self.x[lt:,:])**2 + (self.y[:-lt,:] - self.y[lt:,:])**2
+            # mean of |dz|, not a mean square, so no FFT
             diff_z  = abs(self.z[:-lt,:] - self.z[lt:,:])
             #xy2 = 0.
             #z = 0.
             #for j in range(self.nstep-lt):
             #    xy2 += (self.x[j+lt,:] - self.x[j,:])**2 + (self.y[j+lt,:] - self.y[j,:])**2
             #    z += self.z[j+lt,:] - self.z[j,:]
-            alldist_xy[lt,:] = np.mean(diff_xy,0)  #xy2/(self.nstep-lt)
             alldist_z[lt,:]  = np.mean(diff_z,0)   #z/(self.nstep-lt)
 
         self.dist_xy = np.sqrt(alldist_xy)
@@ -293,11 +364,12 @@ class RunData(object):
     def autocorr_ave(self,select):
         if np.sum(self.acdone) == 0:
             self.ac = np.zeros((self.nstep,self.size,3),float)
-        for i,at in enumerate(xrange(self.size)):
-            if not self.acdone[at]:
-                self.ac[:,i,0] = autocorr(self.x[:,at])
-                self.ac[:,i,1] = autocorr(self.y[:,at])
-                self.ac[:,i,2] = autocorr(self.z[:,at])
+        todo = [at for at in xrange(self.size) if not self.acdone[at]]
+        if len(todo) > 0:
+            # all atoms at once with FFT
+            for k,cor in enumerate([self.x, self.y, self.z]):
+                self.ac[:,todo,k] = autocorr_fft(cor[:,todo])
+            for at in todo:
                 self.acdone[at] = True
         AC = np.mean(self.ac[:,select,:],1)
         print "AC", AC.shape
@@ -334,9 +406,7 @@ class RunData(object):
     def analyze_dist(self,outdir,outfile=None):
         self.calc_dist()
         if outfile is not None:
-            f = open(outdir+"/"+outfile+".dist.obj",'wb')
-            pickle.dump(self,f)
-            f.close()
+            self.save(outdir+"/"+outfile+".dist")
         self.fit_r_vs_time(outdir)
         self.fit_z_vs_time(outdir)
         self.fit_xy_vs_time(outdir)
@@ -355,62 +425,116 @@ class RunData(object):
             kwargs = {"range":(-40,40), "normed":True, "log":True}
             histogram(self.z[:,self.select[moltype]].ravel(),"fig_hist.zlog.%s.png"%moltype,**kwargs)
 
-    def transition_matrix(self,bins,filename=None,shift=1):
-        #self.Tmat = []
+    def transition_matrix(self,bins,filename=None,shift=1,binary=False):
+        """Count the transitions of all atoms for one or more shifts at once
+        and write the raw, cut and pbc variants from the same counts,
+        A[start,end] one value per line (write_Tmat), and if binary also the
+        cut and pbc variants in the binary square format (.npz, A[end,start]
+        with header, readable by Transitions; raw has no valid count label)"""
+        from mcdiff.tools.extract import TransitionCounter, write_Tmat_binary
+        shifts = np.atleast_1d(shift)
         for moltype in self.select:
           if moltype == "O2":    #XXXXXXXXXXXXX TODO FIX !!!!!!!!!!!!!!!!!!!!!!
             for i,allcor in enumerate([self.x, self.y, self.z]):
                 label = ["x","y","z"][i] + "." + moltype
-                cor = allcor[:,self.select[moltype]].transpose()
+                cor = allcor[:,self.select[moltype]]   # ntime x natom
 
-                nb = len(bins)                  # number of bins
-                A = np.zeros((nb+1,nb+1),int)   # also those that are too high/too low
-                for traj in cor:                # add from several atoms
-                    fill_transition_matrix(A,traj,bins,shift=shift)
-                #fill_transition_matrix2(A,cor,bins,shift=shift)
+                # all atoms and shifts in one pass, also those that are too high/too low
+                counter = TransitionCounter(bins,shifts)
+                counter.add(cor)
 
                 # assume external ones are identical transitions, therefore add ?
                 # or put to zero?    # TODO
-                #A[0,-1] = 0
-                #A[-1,0] = 0
-
-                #self.Tmat.append(A)                
-                if filename is not None:
-                    write_Tmat(A,filename+"."+str(shift)+"."+label+".dat")
-                    write_Tmat(A[1:-1,1:-1],filename+"."+str(shift)+"."+label+".cut.dat")
-
-                # periodic boundary conditions
-                A[-1,1:] += A[0,1:]
-                A[1:,-1] += A[1:,0]
-                A[-1,-1] += A[0,0]
-                if filename is not None:
-                    write_Tmat(A[1:,1:],filename+"."+str(shift)+"."+label+".pbc.dat")
+                if filename is None:
+                    continue
+                # periodic boundary conditions: "pbc" folds the external ones
+                for count,ext in [("raw",""),("cut",".cut"),("pbc",".pbc")]:
+                    counts = counter.get_counts(count)   # [k,end,start]
+                    for k,dn in enumerate(shifts):
+                        name = filename+"."+str(dn)+"."+label+ext
+                        write_Tmat(counts[k].transpose(),name+".dat")
+                        if binary and count != "raw":
+                            edges = bins if count == "cut" else None
+                            write_Tmat_binary(counts[k],name+".npz",dn*self.dtc,count,
+                                              edges=edges,dt=self.dtc,dn=dn)
+
+
+def unwrap_pbc(cor,pbc,threshold=0.75):
+    """Remove the jumps of coordinates that cross the periodic box, in place
+    cor  --  coordinates, array ntime or ntime x natom
+    pbc  --  box length, number or array ntime (box of each frame)
+    threshold  --  a step larger than threshold*pbc is a jump of one box length,
+                   None: minimum image, subtract the nearest multiple of the box length
+    The correction of every frame is the cumulative sum of the jumps before it."""
+    ntime = len(cor)
+    pbc = (np.asarray(pbc,float)*np.ones(ntime))[:-1]  # box at the start of each step
+    pbc = pbc.reshape((-1,)+(1,)*(cor.ndim-1))
+    diff = cor[1:]-cor[:-1]
+    if threshold is None:
+        jumps = np.round(diff/pbc)*pbc
+    else:
+        jumps = ((diff > threshold*pbc).astype(float) - (diff < -threshold*pbc))*pbc
+    cor[1:] -= np.cumsum(jumps,axis=0)
+    return cor
+
+def to_json(value):
+    """Settings as plain Python types for json"""
+    if isinstance(value,np.generic):
+        return value.item()
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    if isinstance(value,dict):
+        return dict([(key,to_json(val)) for key,val in value.items()])
+    if isinstance(value,(list,tuple)):
+        return [to_json(val) for val in value]
+    return value
+
+def load_rundata(dirname,mmap_mode="c"):
+    """Reopen a RunData stored with RunData.save, the arrays are
+    memory-mapped and only read when used
+    mmap_mode  --  "c": changes stay in memory, "r+": changes go to the files,
+                   None: read everything now"""
+    import json
+    f = open(os.path.join(dirname,"rundata.json"))
+    meta = json.load(f)
+    f.close()
+    rd = RunData()
+    for attr in meta.pop("arrays"):
+        rd.__dict__[str(attr)] = np.load(os.path.join(dirname,attr+".npy"),mmap_mode=mmap_mode)
+    for attr,value in meta.items():
+        rd.__dict__[str(attr)] = value
+    return rd
 
+def fill_from_dcd(task):
+    """Copy one DCD file into the concatenated arrays, starting at frame offset
+    task  --  (filename, atoms, offset, arrays), arrays is a dictionary with
+              the arrays x, y, z, xtl or with the .npy files to open memory-mapped"""
+    from dcd import DCDReader
+    filename,atoms,offset,arrays = task
+    taco = DCDReader(filename)
+    end = offset+taco.nframes
+    for label in ["x","y","z","xtl"]:
+        array = arrays[label]
+        if isinstance(array,str):
+            array = np.load(array,mmap_mode="r+")
+        if label == "xtl":
+            if taco.has_unitcell:
+                array[offset:end] = taco.xtl
+        elif atoms is None:
+            array[offset:end] = taco.frames[label]
+        else:
+            array[offset:end] = taco.frames[label][:,atoms]
+        if isinstance(array,np.memmap):
+            array.flush()
 
 def autocorr(x,shift=True):
-    if shift is True:
-        vec = x - np.mean(x)
-    else:
-        vec = x
-    result = np.correlate(vec, vec, mode='full')
-    return result[result.size/2:]
+    """Autocorrelation with FFT, see msd.autocorr_fft"""
+    return autocorr_fft(x,shift=shift is True)
 
 def fill_transition_matrix(A,x,bins,shift=1):
-    digitized = np.digitize(x,bins)
-    #ind = np.argsort(x)
-    #digitized = np.searchsorted(x[ind], bins, "right")
-    #digitized = 
-    #print x[:20]
-    #print digitized[:20]
-    #print bins
-
-    start = digitized[0]
-    for i,val in enumerate(digitized[shift:]):
-        start = digitized[i]
-        end = val
-        #print i,start,end
-        A[start,end] += 1
-        #start = end
+    """Add transitions to A[start,end], see transition_matrices"""
+    from mcdiff.tools.extract import transition_matrices
+    A += transition_matrices(x,bins,[shift])[0].transpose()
 
 def fill_transition_matrix2(A,cor,bins,shift=1):
     """This method is equivalent but much too slow,
@@ -620,16 +744,19 @@ def analyze_dist_multipleruns(list_rd,outdir):
 # RUN
 #=====================
 
-def collect_data(indir,chunkstart,chunkend,outdir,outfile,smooth=True,ext='trj',dtc=None):
+def collect_data(indir,chunkstart,chunkend,outdir,outfile,smooth=True,ext='trj',dtc=None,
+                 memmap_dir=None,nproc=1):
     rd = RunData()
 
+    filenames = []
     for i in range(chunkstart,chunkend):
         if smooth:
             filename = indir+"/dyn"+str(i)+".nojump."+ext
         else:
             filename = indir+"/dyn"+str(i)+"."+ext
-        rd.read_charmm_traj(filename,dtc=dtc)
-        print "read:", filename
+        filenames.append(filename)
+    # allocate once, instead of appending every file
+    rd.read_charmm_trajs(filenames,dtc=dtc,memmap_dir=memmap_dir,nproc=nproc)
 
 # TODO make optional
 #        filename = indir+"/dyn"+str(i)+".out"
@@ -647,11 +774,9 @@ def collect_data(indir,chunkstart,chunkend,outdir,outfile,smooth=True,ext='trj',
 
     # store
     if outfile is not None:
-        if smooth: filename = outdir+"/"+outfile+".smooth.obj"
-        else: filename = outdir+"/"+outfile+".nosmooth.obj"
-        f = open(filename,'wb')
-        pickle.dump(rd,f)
-        f.close()
+        if smooth: dirname = outdir+"/"+outfile+".smooth"
+        else: dirname = outdir+"/"+outfile+".nosmooth"
+        rd.save(dirname)   # reopen with load_rundata
     return rd
 
 
@@ -4,34 +4,25 @@ AG, August 13, 2012"""
 import numpy as np
 import matplotlib.pyplot as plt
 
+from textio import read_text
 
-def read_coor_x_or_y_or_z(filename):
+
+def read_coor_x_or_y_or_z(filename,cache=False):
     #print "Reading...", filename
-    f = file(filename)
-    data = []
-    for line in f:
-        if not line.startswith("#"):
-            data.append([float(word) for word in line.split()])
-    f.close()
-    return np.array(data)
+    return read_text(filename,cache=cache)
 
-def read_data_rv(filename):
+def read_data_rv(filename,cache=False):
     """Extract data from files of Rick Venable"""
-    data = []
-    f = file(filename)
-    for line in f:
-        words = line.split()
-        data.append([float(word) for word in words])
-
-    data = np.array(data)
+    data = read_text(filename,comments=None,cache=cache)
     #print "data",data.shape
     #print data[:10,:10]
     return data
 
-def read_coor(filename,rv=False,axis=2,com=False):
+def read_coor(filename,rv=False,axis=2,com=False,cache=False):
     # axis: 0 (x), 1 (y), or 2 (z)
+    # cache: keep a binary copy filename.npy for the next time
     if rv:
-        data = read_data_rv(filename)
+        data = read_data_rv(filename,cache=cache)
         #times = data[:,0]
         if com:
             coms = data[:,1:4]
@@ -40,7 +31,7 @@ def read_coor(filename,rv=False,axis=2,com=False):
             coords = data[:,4:]
             return coords[:,axis::3]
     else:
-        data = read_coor_x_or_y_or_z(filename)
+        data = read_coor_x_or_y_or_z(filename,cache=cache)
         return data   # this is an array
 
 def shift_wrt_layer(data1,data2):
@@ -0,0 +1,242 @@
+"""Mean square displacements for all lag times with FFT
+AG, based on the autocorrelation decomposition of the MSD
+
+MSD(m) = 1/(N-m) sum_k (x[k+m]-x[k])**2
+       = 1/(N-m) [ sum_k x[k+m]**2 + x[k]**2 ] - 2/(N-m) sum_k x[k] x[k+m]
+the first part with cumulative sums, the second part (correlation) with FFT,
+in O(N log N) instead of O(N**2) for all lag times m."""
+
+import numpy as np
+
+from mcdiff.tools.extract import residence_end
+
+
+def correlation_fft(a,b=None):
+    """Correlation c[m] = sum_k a[k] b[k+m], k=0..N-m-1, for all m=0..N-1
+    a, b  --  arrays ntime or ntime x natom, correlation along the time axis
+    Returns array with the same shape as a"""
+    a = np.asarray(a,float)
+    if b is None:
+        b = a
+    b = np.asarray(b,float)
+    assert a.shape == b.shape
+    ntime = len(a)
+    # zero padding to avoid circular correlation, power of 2 is faster
+    n = 2**int(np.ceil(np.log2(2*ntime)))
+    fa = np.fft.rfft(a,n,axis=0)
+    fb = np.fft.rfft(b,n,axis=0)
+    return np.fft.irfft(np.conj(fa)*fb,n,axis=0)[:ntime]
+
+def autocorr_fft(x,shift=True,average=False,normed=False):
+    """Autocorrelation c[m] = sum_k v[k] v[k+m] of a whole block of atoms at once,
+    with v = x - mean(x) if shift, the same as np.correlate(v,v,'full')[ntime-1:]
+    x  --  array ntime or ntime x natom
+    average  --  average over the atoms (second axis)
+    normed  --  divide by the number of time origins ntime-m
+    Returns array ntime (x natom)"""
+    v = np.asarray(x,float)
+    if shift:
+        v = v - np.mean(v,axis=0)
+    c = correlation_fft(v)
+    if normed:
+        c /= (len(v)-np.arange(len(v))).reshape((-1,)+(1,)*(v.ndim-1))
+    if average and v.ndim > 1:
+        c = np.mean(c,axis=1)
+    return c
+
+def msd_fft(a,b=None):
+    """Mean square displacement, averaged over the time origins, for all lag times
+    a  --  coordinates, array ntime or ntime x natom
+    b  --  other coordinate of the same atoms, then the mean of the product of
+           displacements (a[k+m]-a[k])*(b[k+m]-b[k]) is returned (tensor component)
+    Returns array with the same shape as a, with the lag time m along the first axis"""
+    a = np.asarray(a,float)
+    a = a - np.mean(a,axis=0)   # same displacements, less round-off
+    if b is None:
+        b = a
+    else:
+        b = np.asarray(b,float)
+        b = b - np.mean(b,axis=0)
+    ntime = len(a)
+    m = np.arange(ntime)
+    # sum_{k=m}^{N-1} a[k]b[k] + sum_{k=0}^{N-m-1} a[k]b[k]
+    cs = np.concatenate((np.zeros((1,)+a.shape[1:]),np.cumsum(a*b,axis=0)))
+    s1 = cs[ntime]-cs[m]+cs[ntime-m]
+    s2 = correlation_fft(a,b)
+    if b is not a:
+        s2 = s2 + correlation_fft(b,a)
+    else:
+        s2 = 2*s2
+    norm = (ntime-m).reshape((-1,)+(1,)*(a.ndim-1))
+    msd = (s1-s2)/norm
+    msd[0] = 0.
+    if b is a:
+        msd = np.maximum(msd,0.)   # round-off of the FFT
+    return msd
+
+def calc_msd(x,y,z,shifts=None):
+    """MSD in xy, z and r for lag shifts
+    x, y, z  --  coordinates, ntime x natom
+    Returns dist2_xy,dist2_z,dist2_r, each len(shifts) x natom"""
+    ntime = len(x)
+    if shifts is None:
+        shifts = np.arange(ntime)
+    shifts = np.asarray(shifts)
+    assert shifts.max() < ntime
+    dist2_xy = (msd_fft(x)+msd_fft(y))[shifts]
+    dist2_z = msd_fft(z)[shifts]
+    return dist2_xy,dist2_z,dist2_xy+dist2_z
+
+def calc_msd_matrix(x,y,z,shifts=None):
+    """Six components xx,yy,zz,xy,xz,yz of the mean displacement tensor
+    Returns list of 6 arrays len(shifts) x natom"""
+    ntime = len(x)
+    if shifts is None:
+        shifts = np.arange(ntime)
+    shifts = np.asarray(shifts)
+    assert shifts.max() < ntime
+    return [msd_fft(a,b)[shifts] for a,b in [(x,None),(y,None),(z,None),(x,y),(x,z),(y,z)]]
+
+
+class DisplacementDistribution(object):
+    """Distribution of the displacements for several lag shifts, accumulated
+    in fixed-size arrays (moments and histograms) instead of keeping every
+    displacement, such that long trajectories can be fed in chunks of frames.
+    The last max(shifts) frames of a chunk are kept, such that displacements
+    across chunk boundaries are counted, each exactly once.
+    shifts  --  lag shifts (number of frames)
+    edges_xy  --  bin edges for the histogram of the xy-distance r_xy
+    edges_z  --  bin edges for the histogram of the z-displacement dz (signed)
+    Histograms have len(edges)+1 bins (first and last bin are below/above the edges)."""
+
+    def __init__(self,shifts,edges_xy=None,edges_z=None):
+        self.shifts = np.array(shifts,int)
+        assert (self.shifts > 0).all()
+        self.maxshift = self.shifts.max()
+        nlags = len(self.shifts)
+        self.count = np.zeros(nlags,int)        # number of displacements
+        self.sums_xy = np.zeros((nlags,2),float)  # sum of r_xy**2, r_xy**4
+        self.sums_z = np.zeros((nlags,4),float)   # sum of dz, dz**2, dz**3, dz**4
+        self.edges_xy = edges_xy
+        self.edges_z = edges_z
+        if edges_xy is not None:
+            self.hist_xy = np.zeros((nlags,len(edges_xy)+1),int)
+        if edges_z is not None:
+            self.hist_z = np.zeros((nlags,len(edges_z)+1),int)
+        self.tail = None
+
+    def add(self,x,y,z):
+        """Add a chunk of frames, x, y, z  --  coordinates ntime or ntime x natom"""
+        data = [np.asarray(c,float) for c in (x,y,z)]
+        if self.tail is None:
+            ntail = 0
+        else:
+            ntail = len(self.tail[0])
+            data = [np.concatenate((t,d)) for t,d in zip(self.tail,data)]
+        X,Y,Z = data
+        ntime = len(Z)
+        for k,shift in enumerate(self.shifts):
+            # only displacements that end in the new frames
+            first = max(ntail,shift)
+            if first >= ntime:
+                continue
+            r2 = (X[first:]-X[first-shift:ntime-shift])**2 + (Y[first:]-Y[first-shift:ntime-shift])**2
+            dz = Z[first:]-Z[first-shift:ntime-shift]
+            self.count[k] += dz.size
+            self.sums_xy[k] += [np.sum(r2),np.sum(r2**2)]
+            dz2 = dz**2
+            self.sums_z[k] += [np.sum(dz),np.sum(dz2),np.sum(dz2*dz),np.sum(dz2**2)]
+            if self.edges_xy is not None:
+                self.hist_xy[k] += np.bincount(np.digitize(np.sqrt(r2).ravel(),self.edges_xy),
+                                      minlength=len(self.edges_xy)+1)
+            if self.edges_z is not None:
+                self.hist_z[k] += np.bincount(np.digitize(dz.ravel(),self.edges_z),
+                                      minlength=len(self.edges_z)+1)
+        self.tail = [d[-self.maxshift:].copy() for d in data]
+
+    def merge(self,other):
+        """Add the distribution of another trajectory, same shifts and edges"""
+        assert (self.shifts == other.shifts).all()
+        self.count += other.count
+        self.sums_xy += other.sums_xy
+        self.sums_z += other.sums_z
+        if self.edges_xy is not None:
+            self.hist_xy += other.hist_xy
+        if self.edges_z is not None:
+            self.hist_z += other.hist_z
+
+    def msd(self):
+        """Mean square displacement, returns msd_xy,msd_z,msd_r, each len(shifts)"""
+        msd_xy = self.sums_xy[:,0]/self.count
+        msd_z = self.sums_z[:,1]/self.count
+        return msd_xy,msd_z,msd_xy+msd_z
+
+    def non_gaussian(self):
+        """Non-Gaussian parameters, zero for Gaussian displacements,
+        alpha_xy = <r_xy**4>/(2<r_xy**2>**2)-1 and alpha_z = <dz**4>/(3<dz**2>**2)-1"""
+        m_xy = self.sums_xy/self.count[:,None]
+        m_z = self.sums_z/self.count[:,None]
+        return m_xy[:,1]/(2*m_xy[:,0]**2)-1., m_z[:,3]/(3*m_z[:,1]**2)-1.
+
+def collect_dist_hist(x,y,z,shifts=None,edges_xy=None,edges_z=None,chunksize=1000):
+    """Displacement distribution of a trajectory in chunks of chunksize frames,
+    memory-bounded alternative to distance.collect_dist
+    x, y, z  --  coordinates, ntime x natom
+    shifts  --  lag shifts, default all 1..ntime-1
+    Returns a DisplacementDistribution"""
+    ntime = len(x)
+    if shifts is None:
+        shifts = np.arange(1,ntime)
+    dist = DisplacementDistribution(shifts,edges_xy=edges_xy,edges_z=edges_z)
+    for start in range(0,ntime,chunksize):
+        end = start+chunksize
+        dist.add(x[start:end],y[start:end],z[start:end])
+    return dist
+
+def condz_msd(x,y,z,edges,shifts,zpbc=None,surv=False):
+    """Mean square displacement conditioned on the starting z-bin,
+    for several lag shifts, all atoms at once
+    x, y, z  --  coordinates, ntime x natom
+    edges  --  z-bin edges, len(edges)+1 bins (first and last bin are below/above the edges)
+    zpbc  --  box length, z is put back in the box [-zpbc/2,zpbc/2[ to find the bin
+    surv  --  only count the displacements that stayed in their bin during the lag
+    Returns count, sums, initial
+      count  --  number of displacements, (len(edges)+1) x len(shifts)
+      sums  --  sum of the squared displacements xy, z and r, 3 x (len(edges)+1) x len(shifts)
+      initial  --  number of starting frames (including those that left the bin),
+                   (len(edges)+1) x len(shifts), survival probability is count/initial"""
+    x = np.asarray(x,float)
+    y = np.asarray(y,float)
+    z = np.asarray(z,float)
+    ntime = len(z)
+    nb = len(edges)+1
+    nlags = len(shifts)
+    if zpbc is not None:
+        zbox = z-zpbc*np.floor(z/zpbc+0.5)
+    else:
+        zbox = z
+    digitized = np.digitize(zbox.ravel(),edges).reshape(z.shape)   # once for all shifts
+    if surv:
+        end = residence_end(digitized)
+        frames = np.arange(ntime).reshape((-1,)+(1,)*(z.ndim-1))
+
+    count = np.zeros((nb,nlags),int)
+    sums = np.zeros((3,nb,nlags),float)
+    initial = np.zeros((nb,nlags),int)
+    for k,dn in enumerate(shifts):
+        assert dn > 0 and dn < ntime
+        dist2_xy = (x[dn:]-x[:-dn])**2 + (y[dn:]-y[:-dn])**2
+        dist2_z = (z[dn:]-z[:-dn])**2
+        start = digitized[:-dn]
+        initial[:,k] = np.bincount(start.ravel(),minlength=nb)
+        if surv:
+            stayed = end[:-dn] >= frames[:-dn]+dn
+            start = start[stayed]
+            dist2_xy = dist2_xy[stayed]
+            dist2_z = dist2_z[stayed]
+        start = start.ravel()
+        count[:,k] = np.bincount(start,minlength=nb)
+        sums[0,:,k] = np.bincount(start,weights=dist2_xy.ravel(),minlength=nb)
+        sums[1,:,k] = np.bincount(start,weights=dist2_z.ravel(),minlength=nb)
+    sums[2] = sums[0]+sums[1]
+    return count,sums,initial
@@ -0,0 +1,93 @@
+"""Fast readers for large text files with columns of numbers
+(coordinates, profiles), one line per frame
+
+The lines are parsed in bulk by numpy instead of line by line in Python.
+Optionally, the array is cached in binary format next to the text file,
+filename.npy (one cache per comment setting, see cache_filename), which is
+used as long as it is newer than the text file."""
+
+import os
+import binascii
+import itertools
+import numpy as np
+
+
+def parse_lines(lines,filename=""):
+    """Parse lines with the same number of columns into an array nlines x ncolumns"""
+    if len(lines) == 0:
+        return np.zeros((0,0),float)
+    ncols = np.array(map(len,map(str.split,lines)))
+    ncol = ncols[0]
+    if (ncols != ncol).any():
+        i = np.nonzero(ncols != ncol)[0][0]
+        raise ValueError("line %i has %i columns instead of %i in %s: %s"
+                         %(i,ncols[i],ncol,filename,lines[i].strip()))
+    data = np.fromstring(" ".join(lines),dtype=float,sep=" ")
+    if data.size != ncol*len(lines):   # a word that is not a number
+        raise ValueError("could not read all numbers in %s"%filename)
+    return data.reshape((len(lines),ncol))
+
+def data_lines(f,comments="#"):
+    """Lines of a file without the comment lines and the empty lines"""
+    for line in f:
+        if comments is not None and line.startswith(comments):
+            continue
+        if line.strip():
+            yield line
+
+def cache_filename(filename,comments="#"):
+    """Binary cache of a text file, a separate one for each comment setting:
+    filename.npy for "#", filename.nocomments.npy for None, else
+    filename.comments-<hex code of comments>.npy"""
+    if comments == "#":
+        return filename+".npy"
+    if comments is None:
+        return filename+".nocomments.npy"
+    return filename+".comments-%s.npy"%binascii.hexlify(comments)
+
+def read_cache(filename,comments="#"):
+    """Cached array of a text file, or None if absent or older than the text file"""
+    cache = cache_filename(filename,comments)
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(filename):
+        return np.load(cache)
+    return None
+
+def write_cache(filename,data,comments="#"):
+    try:
+        np.save(cache_filename(filename,comments),data)
+    except (IOError,OSError):
+        print "WARNING: could not write cache of %s" %filename
+
+def read_text(filename,columns=None,comments="#",cache=False):
+    """Read a text file with columns of numbers
+    columns  --  column indices to keep, default all columns
+    comments  --  lines starting with this are skipped (None: no comments)
+    cache  --  use/write the binary cache, see cache_filename
+    Returns float array nlines x ncolumns (or nlines if columns is one index)"""
+    data = None
+    if cache:
+        data = read_cache(filename,comments)
+    if data is None:
+        f = open(filename)
+        data = parse_lines(list(data_lines(f,comments)),filename)
+        f.close()
+        if cache:
+            write_cache(filename,data,comments)
+    if columns is not None:
+        data = data[:,columns]
+    return data
+
+def iter_text_chunks(filename,chunksize,columns=None,comments="#"):
+    """Read a text file in chunks of chunksize lines
+    Yields float arrays chunksize x ncolumns (the last chunk may be shorter)"""
+    f = open(filename)
+    lines = data_lines(f,comments)
+    while True:
+        chunk = list(itertools.islice(lines,chunksize))
+        if len(chunk) == 0:
+            break
+        data = parse_lines(chunk,filename)
+        if columns is not None:
+            data = data[:,columns]
+        yield data
+    f.close()
@@ -5,9 +5,12 @@
 #
 
 import numpy as np
+from collections import OrderedDict
 from reading import guess_dim_transition_square, read_transition_square
 from reading import read_transition_header
 from reading import guess_dim_transition_cube, read_transition_cube
+from reading import read_transition_file, read_transition_file_header
+from reading import read_transition_file_sparse
 
 """
 lt  --  lag time between snapshots [in ps]
@@ -20,7 +23,13 @@ count  --  how transitions were counted [pbc, cut, ...]
 """
 
 class Transitions(object):
-    def __init__(self,list_filenames,reduction=False):
+    def __init__(self,list_filenames,reduction=False,lazy=False,cache_size=None):
+        """
+        lazy  --  only read the headers now, and read the transition counts
+                  of a lag time when they are accessed for the first time
+        cache_size  --  with lazy, keep at most cache_size lag times in memory
+                        (least recently used are dropped), None keeps all
+        """
         self.started = False
         self.dim_lt = len(list_filenames)  # number of lagtimes (lt)
         assert self.dim_lt > 0
@@ -31,21 +40,32 @@ class Transitions(object):
         self.list_dn = []
         self.list_trans = []
         for filename in list_filenames:
-            self.read_transition(filename,reduction=reduction)
+            if lazy:
+                header,shape = read_transition_file_header(filename)
+                self.add_header(header,shape)
+            else:
+                self.read_transition(filename)
         # convert
         self.list_lt = np.array(self.list_lt)
         self.list_dt = np.array(self.list_dt)
         self.list_dn = np.array(self.list_dn)
-        self.list_trans = np.array(self.list_trans)
+        if lazy:
+            self.list_trans = LazyTransitionList(list_filenames,
+                    (self.dim_trans,self.dim_trans),cache_size=cache_size)
+        else:
+            self.list_trans = np.array(self.list_trans)
         self.min_lt = min(self.list_lt)
+        if reduction:
+            self.reduce()
 
-    def read_transition(self,filename,reduction=False):
-        dim_trans = guess_dim_transition_square(filename)
-        header = read_transition_header(filename)
-        transmatrix = read_transition_square(filename,dim_trans)
+    def read_transition(self,filename):
+        header,transmatrix = read_transition_file(filename)
+        self.add_header(header,transmatrix.shape)
+        self.list_trans.append(transmatrix)
 
-        if reduction:
-            dim_trans,header,transmatrix = reduce_Tmat(dim_trans,header,transmatrix)
+    def add_header(self,header,shape):
+        assert len(shape) == 2
+        dim_trans = shape[0]
 
         if not self.started: # initialize settings
             self.started = True
@@ -64,28 +84,189 @@ class Transitions(object):
         self.list_lt.append(header['lt'])
         self.list_dt.append(header['dt'])
         self.list_dn.append(header['dn'])
-        self.list_trans.append(transmatrix)
+
+    def reduce(self):
+        """Delete the empty rows/columns at both ends of the transition matrices,
+        using the same bins for every lag time"""
+        reduce_transitions_object(self)
+
+    def rebin(self,k):
+        """Merge every k adjacent bins into one coarse bin, see coarsen_transitions"""
+        self.list_trans,self.edges = coarsen_transitions(self.list_trans,self.edges,self.count,k)
+        self.dim_trans = self.list_trans.shape[-1]
+
+class LazyTransitionList(object):
+    """Transition matrices of several lag times, read from file on first access
+
+    Behaves like the dim_lt x N x N array list_trans where it is used:
+    list_trans[ilag], list_trans[ilag,:,:], iteration over the lag times,
+    len(), shape, and np.array(list_trans) (which reads everything).
+    cache_size  --  keep at most cache_size matrices in memory, the least
+                    recently used one is dropped first, None keeps all
+    """
+    def __init__(self,list_filenames,shape,cache_size=None):
+        self.list_filenames = list_filenames
+        self.matrix_shape = tuple(shape)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.transforms = []   # applied to every matrix after reading
+
+    @property
+    def shape(self):
+        return (len(self.list_filenames),)+self.matrix_shape
+
+    def __len__(self):
+        return len(self.list_filenames)
+
+    def load(self,ilag):
+        header,A = read_transition_file(self.list_filenames[ilag])
+        for func in self.transforms:
+            A = func(A)
+        return A
+
+    def get(self,ilag):
+        if ilag < 0:
+            ilag += len(self)
+        if ilag in self.cache:
+            A = self.cache.pop(ilag)   # re-insert: most recently used
+        else:
+            A = self.load(ilag)
+        if self.cache_size is None or self.cache_size > 0:
+            self.cache[ilag] = A
+            if self.cache_size is not None and len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return A
+
+    def __getitem__(self,key):
+        if isinstance(key,tuple):
+            return self.get(key[0])[key[1:]]
+        if isinstance(key,slice):
+            return np.array([self.get(i) for i in range(*key.indices(len(self)))])
+        return self.get(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def __array__(self,dtype=None):
+        return np.array([A for A in self],dtype=dtype)
+
+    def transform(self,func,shape):
+        """Apply func to every matrix from now on, shape is the new matrix shape"""
+        self.transforms.append(func)
+        for ilag in self.cache:
+            self.cache[ilag] = func(self.cache[ilag])
+        self.matrix_shape = tuple(shape)
+        return self
+
+def support_mask(list_trans):
+    """Find the bins that are visited in any of the transition matrices
+    list_trans  --  array of transition matrices, dim_lt x N x N,
+                    or of radial transition cubes, dim_lt x dim_rad x N x N
+    Returns a boolean mask of length N: bin i is in the support if
+    row i and column i have non-zero counts (summed over all lag times)"""
+    n = list_trans.shape[-1]
+    if isinstance(list_trans,LazyTransitionList):
+        total = np.zeros((n,n))
+        for A in list_trans:   # one lag time at a time
+            total += np.sum(np.reshape(A,(-1,n,n)),0)
+    elif isinstance(list_trans,SparseCubes):
+        total = list_trans.sum_radial()
+    else:
+        total = np.sum(np.reshape(list_trans,(-1,n,n)),0)   # N x N
+    return (np.sum(total,0) != 0) & (np.sum(total,1) != 0)
+
+def reduce_transitions(list_trans):
+    """Cut off the empty rows/columns at both ends of all transition matrices
+    list_trans  --  array dim_lt x N x N, or radial cubes dim_lt x dim_rad x N x N
+    Returns the reduced array and select, the indices of the bins that are kept.
+    One common selection is used for all lag times (and radial bins), and
+    nothing is cut in the middle."""
+    mask = support_mask(list_trans)
+    if not mask.any():
+        raise ValueError("can not reduce transition matrices without transitions")
+    indices = np.flatnonzero(mask)
+    select = np.arange(indices[0],indices[-1]+1)   # I do not cut in the middle
+    if len(select) == len(mask):
+        return list_trans,select
+    if isinstance(list_trans,LazyTransitionList):
+        return list_trans.transform(lambda A: A[...,select[:,None],select],
+                                    (len(select),len(select))),select
+    if isinstance(list_trans,SparseCubes):
+        return list_trans.take_bins(select),select
+    # one fancy-indexing pass over all lag times (and radial bins)
+    return list_trans[...,select[:,None],select],select
+
+def reduce_transitions_object(trans):
+    """Reduce the transition matrices of a Transitions or RadTransitions object"""
+    dim_trans = trans.dim_trans
+    trans.list_trans,select = reduce_transitions(trans.list_trans)
+    if len(select) == dim_trans:
+        print "reduction transition matrix: dim_trans from %i to %i, nothing happened" %(dim_trans,dim_trans)
+        return
+    trans.dim_trans = len(select)
+    trans.edges = trans.edges[select[0]:select[-1]+2]
+    trans.count = "cut"   # TODO this is necessary!!!
+    print "reduction transition matrix: dim_trans from %i to %i" %(dim_trans,trans.dim_trans)
 
 def reduce_Tmat(dim_trans,header,transmatrix):
-    # check for zeros
-    select = []
-    for i in range(len(transmatrix)):
-        if sum(transmatrix[i,:]) != 0 and sum(transmatrix[:,i]) != 0:
-            select.append(i)
-    select = range(min(select),max(select)+1)   # I do not cut in the middle
-    if select[0]==0 and select[-1]==len(transmatrix):    # what if I cut off zeros???  TODO
-       print "reduction transition matrix: dim_trans from %i to %i, nothing happened" %(dim_trans+redux,dim_trans)
-       return dim_trans,header,transmatrix
-    else: 
-       redux = len(transmatrix)-len(select)
- 
-       dim_trans = dim_trans-redux
-       trans = np.zeros((dim_trans,dim_trans))
-       trans[:,:] = np.take(np.take(transmatrix,select,0),select,1)
-       header["count"] = "cut"   # TODO this is necessary!!!
-       header["edges"] = header["edges"][select+[select[-1]+1]]
-       print "reduction transition matrix: dim_trans from %i to %i" %(dim_trans+redux,dim_trans)
-    return dim_trans,header,trans
+    """Reduce a single transition matrix, see reduce_transitions"""
+    trans,select = reduce_transitions(transmatrix[np.newaxis])
+    if len(select) == dim_trans:
+        print "reduction transition matrix: dim_trans from %i to %i, nothing happened" %(dim_trans,dim_trans)
+        return dim_trans,header,transmatrix
+    header["count"] = "cut"   # TODO this is necessary!!!
+    if "edges" in header:
+        header["edges"] = header["edges"][select[0]:select[-1]+2]
+    print "reduction transition matrix: dim_trans from %i to %i" %(dim_trans,len(select))
+    return len(select),header,trans[0]
+
+def block_sum_bins(A,m,k):
+    """Sum the counts in the last two axes over blocks of k x k bins,
+    the first m*k bins are used"""
+    lead = A.shape[:-2]
+    return A[...,:m*k,:m*k].reshape(lead+(m,k,m,k)).sum(axis=-1).sum(axis=-2)
+
+def coarsen_transitions(list_trans,edges,count,k,redges=None,kr=1):
+    """Merge k adjacent bins by block-summing the transition counts,
+    no need to count the transitions again from the trajectory
+    list_trans  --  array dim_lt x N x N, or radial cubes dim_lt x dim_rad x N x N
+    edges  --  bin edges, N+1 elements
+    count  --  pbc: N should be a multiple of k, the periodic image must stay intact
+               cut: the N%k bins at the end that do not fill a coarse bin are cut off
+    redges  --  radial bin edges, dim_rad elements, only for radial cubes
+    kr  --  number of adjacent radial bins to merge, dim_rad should be a multiple of kr
+    Returns the coarse counts and edges (and redges if these were given)"""
+    n = list_trans.shape[-1]
+    assert k >= 1 and kr >= 1
+    m = n/k   # number of coarse bins
+    if n%k != 0:
+        if "pbc" in count:
+            raise ValueError("with pbc counting, the number of bins %i should be a multiple of %i" %(n,k))
+        print "rebinning transition matrix: cutting off the last %i bins" %(n-m*k)
+    if m == 0:
+        raise ValueError("can not merge %i bins into bins of %i" %(n,k))
+    if isinstance(list_trans,LazyTransitionList):
+        A = list_trans.transform(lambda B: block_sum_bins(B,m,k),(m,m))
+    elif isinstance(list_trans,SparseCubes):
+        A = list_trans   # z- and radial bins are merged together below
+    else:
+        A = block_sum_bins(list_trans,m,k)
+    coarse_edges = edges[:m*k+1:k]
+    print "rebinning transition matrix: dim_trans from %i to %i" %(n,m)
+    if redges is None:
+        assert kr == 1
+        return A,coarse_edges
+
+    # radial bins, axis -3
+    dim_rad = A.shape[-3]
+    assert dim_rad == len(redges)
+    if dim_rad%kr != 0:
+        raise ValueError("number of radial bins %i should be a multiple of %i" %(dim_rad,kr))
+    if isinstance(A,SparseCubes):
+        return A.coarsen(m,k,kr),coarse_edges,redges[::kr]
+    A = A.reshape(A.shape[:-3]+(dim_rad/kr,kr,m,m)).sum(axis=-3)
+    return A,coarse_edges,redges[::kr]
 
 def cut_transitions_square(filename,start,end,outfile,count="cut"):
     """Read transitions from file and cut out the piece start->end,
@@ -159,7 +340,10 @@ def merge_transitions(trans,outfile,):
     # edges will be checked to be equal when trans object is created
     edges = trans.edges
     count = trans.count
-    A = np.rint(np.sum(trans.list_trans,0)).astype(int)
+    if isinstance(trans.list_trans,SparseCubes):
+        A = trans.list_trans.sum_lagtimes().todense()
+    else:
+        A = np.rint(np.sum(trans.list_trans,0)).astype(int)
     if len(trans.list_trans.shape) == 3:
         write_Tmat_square(A,outfile,lt,count,edges=edges,dt=dt,dn=dn)
     elif len(trans.list_trans.shape) == 4:
@@ -167,8 +351,182 @@ def merge_transitions(trans,outfile,):
     else: raise ValueError("list_trans does not have expected dimension (3 or 4): %i" 
                  %len(trans.list_trans.shape))
 
+def check_same_header(header,header2,filename=""):
+    """Assert that two transition files were counted with the same settings,
+    such that their counts can be added"""
+    for key in ['count','dn']:
+        if header.get(key) != header2.get(key):
+            raise ValueError("%s differs in %s: %s versus %s" %(key,filename,header.get(key),header2.get(key)))
+    for key in ['lt','dt']:
+        if abs(header[key]-header2[key]) > 1e-5:
+            raise ValueError("%s differs in %s: %s versus %s" %(key,filename,header[key],header2[key]))
+    for key in ['edges','redges']:
+        if (key in header) != (key in header2):
+            raise ValueError("%s only in one of the headers: %s" %(key,filename))
+        if key in header:
+            if len(header[key]) != len(header2[key]) or (header[key] != header2[key]).any():
+                raise ValueError("%s differ in %s" %(key,filename))
+
+def sum_transition_files(list_filenames):
+    """Add the transition counts of files with equal settings one by one
+    Only the running total is kept in memory.
+    Returns the header of the first file and the summed counts (int)."""
+    assert len(list_filenames) > 0
+    header = None
+    for filename in list_filenames:
+        header2,A = read_transition_file(filename)
+        if header is None:
+            header = header2
+            total = np.rint(A).astype(int)
+        else:
+            check_same_header(header,header2,filename)
+            if A.shape != total.shape:
+                raise ValueError("shape differs in %s: %s versus %s" %(filename,A.shape,total.shape))
+            total += np.rint(A).astype(int)
+    return header,total
+
+def merge_transition_files(list_filenames,outfile,nproc=1,binary=False):
+    """Sum the transition matrices (or radial cubes) of many runs of the same
+    system, with equal lag times, and write the total to outfile
+
+    Files are streamed: every worker keeps only its running total in memory.
+    nproc  --  number of processes, each sums a part of the files
+    binary  --  write outfile in binary numpy format instead of text,
+                .npz is added to outfile if missing"""
+    from mcdiff.tools.extract import write_Tmat_file
+    assert outfile not in list_filenames  # do not overwrite
+    nproc = max(1,min(nproc,len(list_filenames)))
+    if nproc == 1:
+        header,A = sum_transition_files(list_filenames)
+    else:
+        import multiprocessing
+        chunks = [list_filenames[i::nproc] for i in range(nproc)]
+        pool = multiprocessing.Pool(nproc)
+        partial_sums = pool.map(sum_transition_files,chunks)
+        pool.close()
+        pool.join()
+        header,A = partial_sums[0]
+        for chunk,(header2,A2) in zip(chunks[1:],partial_sums[1:]):
+            check_same_header(header,header2,chunk[0])
+            if A2.shape != A.shape:
+                raise ValueError("shape differs in %s: %s versus %s" %(chunk[0],A2.shape,A.shape))
+            A += A2
+    outfile = write_Tmat_file(A,outfile,header['lt'],header['count'],edges=header.get('edges'),
+            redges=header.get('redges'),dt=header['dt'],dn=header['dn'],binary=binary)   # binary: .npz added
+    print "merged %i transition files into %s" %(len(list_filenames),outfile)
+    return A
+
+class SparseCube(object):
+    """Radial transition counts of one lag time, dim_rad x N x N, of which
+    only the non-zero elements are stored
+    r, end, start  --  index arrays of the non-zero elements
+    counts  --  integer counts of these elements"""
+    def __init__(self,shape,r,end,start,counts):
+        assert len(shape) == 3
+        self.shape = tuple(shape)
+        self.r = r
+        self.end = end
+        self.start = start
+        self.counts = counts
+
+    @classmethod
+    def from_dense(cls,B):
+        r,end,start = np.nonzero(B)
+        return cls(B.shape,r.astype(np.int32),end.astype(np.int32),
+                   start.astype(np.int32),np.rint(B[r,end,start]).astype(int))
+
+    def todense(self):
+        B = np.zeros(self.shape,int)
+        np.add.at(B,(self.r,self.end,self.start),self.counts)
+        return B
+
+    def __array__(self,dtype=None):
+        return np.asarray(self.todense(),dtype=dtype)
+
+    def sum_radial(self):
+        """N x N counts, summed over the radial bins"""
+        n = self.shape[-1]
+        total = np.bincount(self.end.astype(int)*n+self.start,weights=self.counts,minlength=n*n)
+        return np.rint(total).astype(int).reshape((n,n))
+
+    def compress(self):
+        """Add up the counts of elements that occur more than once"""
+        dim_rad,n,n = self.shape
+        flat = (self.r.astype(int)*n+self.end)*n+self.start
+        unique,inverse = np.unique(flat,return_inverse=True)
+        counts = np.rint(np.bincount(inverse,weights=self.counts)).astype(int)
+        r,end,start = np.unravel_index(unique,self.shape)
+        return SparseCube(self.shape,r.astype(np.int32),end.astype(np.int32),
+                          start.astype(np.int32),counts)
+
+    def __add__(self,other):
+        assert self.shape == other.shape
+        return SparseCube(self.shape,np.concatenate([self.r,other.r]),
+                   np.concatenate([self.end,other.end]),np.concatenate([self.start,other.start]),
+                   np.concatenate([self.counts,other.counts])).compress()
+
+    def take_bins(self,select):
+        """Keep the contiguous z-bins select[0],...,select[-1]"""
+        first,last = select[0],select[-1]
+        keep = (self.end>=first) & (self.end<=last) & (self.start>=first) & (self.start<=last)
+        return SparseCube((self.shape[0],len(select),len(select)),self.r[keep],
+                   self.end[keep]-first,self.start[keep]-first,self.counts[keep])
+
+    def coarsen(self,m,k,kr=1):
+        """Merge k adjacent z-bins and kr adjacent radial bins,
+        keep the first m coarse z-bins"""
+        end = self.end/k
+        start = self.start/k
+        keep = (end<m) & (start<m)
+        return SparseCube((self.shape[0]/kr,m,m),self.r[keep]/kr,
+                   end[keep],start[keep],self.counts[keep]).compress()
+
+
+class SparseCubes(object):
+    """Sparse radial transition cubes of all lag times,
+    in place of the dense array dim_lt x dim_rad x N x N
+    list_trans[ilag] is the SparseCube of lag time ilag"""
+    def __init__(self,cubes):
+        self.cubes = cubes
+        for cube in cubes:
+            assert cube.shape == cubes[0].shape
+
+    @property
+    def shape(self):
+        return (len(self.cubes),)+self.cubes[0].shape
+
+    def __len__(self):
+        return len(self.cubes)
+
+    def __getitem__(self,ilag):
+        return self.cubes[ilag]
+
+    def __iter__(self):
+        return iter(self.cubes)
+
+    def __array__(self,dtype=None):
+        return np.array([cube.todense() for cube in self.cubes],dtype=dtype)
+
+    def sum_radial(self):
+        """N x N counts, summed over the lag times and radial bins"""
+        return np.sum([cube.sum_radial() for cube in self.cubes],0)
+
+    def sum_lagtimes(self):
+        """SparseCube with the counts summed over the lag times"""
+        total = self.cubes[0]
+        for cube in self.cubes[1:]:
+            total = total+cube
+        return total
+
+    def take_bins(self,select):
+        return SparseCubes([cube.take_bins(select) for cube in self.cubes])
+
+    def coarsen(self,m,k,kr=1):
+        return SparseCubes([cube.coarsen(m,k,kr) for cube in self.cubes])
+
+
 class RadTransitions(object):
-    def __init__(self,list_filenames):
+    def __init__(self,list_filenames,reduction=False):
         self.started = False
         self.dim_lt = len(list_filenames)  # number of lagtimes (lt)
         assert self.dim_lt > 0
@@ -184,14 +542,15 @@ class RadTransitions(object):
         self.list_lt = np.array(self.list_lt)
         self.list_dt = np.array(self.list_dt)
         self.list_dn = np.array(self.list_dn)
-        self.list_trans = np.array(self.list_trans)
+        self.list_trans = SparseCubes(self.list_trans)
         print "trans:",self.list_trans.shape
         self.min_lt = min(self.list_lt)
+        if reduction:
+            self.reduce()
 
     def read_transition(self,filename):
-        dim_rad,dim_trans = guess_dim_transition_cube(filename)
-        header = read_transition_header(filename)   # same function....
-        transmatrix = read_transition_cube(filename,dim_rad,dim_trans)
+        header,shape,entries = read_transition_file_sparse(filename)
+        dim_rad,dim_trans = shape[:2]
 
         if not self.started: # initialize settings
             self.started = True
@@ -218,5 +577,16 @@ class RadTransitions(object):
         self.list_lt.append(header['lt'])
         self.list_dt.append(header['dt'])
         self.list_dn.append(header['dn'])
-        self.list_trans.append(transmatrix)
+        self.list_trans.append(SparseCube(shape,*entries))
+
+    def reduce(self):
+        """Delete the empty z-rows/columns at both ends of the radial transition
+        cubes, using the same bins for every lag time and radial bin"""
+        reduce_transitions_object(self)
 
+    def rebin(self,k,kr=1):
+        """Merge every k adjacent z-bins and every kr adjacent radial bins,
+        see coarsen_transitions"""
+        self.list_trans,self.edges,self.redges = coarsen_transitions(self.list_trans,
+                self.edges,self.count,k,redges=self.redges,kr=kr)
+        self.dim_rad,self.dim_trans = self.list_trans.shape[-3:-1]
@@ -12,17 +12,29 @@ from scipy import linalg, special
 
 def rad_log_like_lag(dim_trans,dim_rad, num_lag, rate, wrad, lagtimes, transition,
             rad,lmax,bessel0_zeros,bessels, epsilon ):
-    """calculate log-likelihood summed over different lag times"""
-    tiny = np.empty((dim_rad,dim_trans,dim_trans))
-    tiny.fill(1.e-32) # lower bound of propagator (to avoid NaN's)
+    """calculate log-likelihood summed over different lag times
+    transition  --  SparseCubes, transition[ilag] has the non-zero counts
+                    (r,end,start,counts) of lag time ilag, or a dense array
+                    num_lag x dim_rad x dim_trans x dim_trans"""
     log_like = np.float64(0.0)
     # add contributions of different lag times
     for ilag in range(num_lag):
+        cube = transition[ilag]
+        if hasattr(cube,"counts"):
+            # propagator is only needed where transitions were counted
+            propagator = propagator_radial_diffusion_sparse(dim_trans,dim_rad,
+                          rate,wrad,lagtimes[ilag],lmax,bessel0_zeros,bessels,
+                          cube.r,cube.end,cube.start)
+            counts = cube.counts
+        else:
+            propagator = propagator_radial_diffusion(dim_trans,dim_rad,
+                          rate,wrad,lagtimes[ilag],lmax,bessel0_zeros,bessels)
+            counts = cube
         # use elementwise maximum with tiny to avoid NaN errors
-        lnpropagator =  np.log(np.maximum(propagator_radial_diffusion(dim_trans,dim_rad,
-                          rate,wrad,lagtimes[ilag],lmax,bessel0_zeros,bessels),tiny))
+        # lower bound of propagator is tiny=1.e-32
+        lnpropagator = np.log(np.maximum(propagator,1.e-32))
         # sum up log likelihood
-        log_like += np.sum( transition[ilag,:,:,:] * lnpropagator[:,:,:] )
+        log_like += np.sum( counts * lnpropagator )
 
     # smoothness prior for log(D)
     if (epsilon > 0.0):
@@ -129,6 +141,22 @@ def propagator_radial_diffusion(n,dim_rad,rate,wrad,lagtime,
     #propagator /= np.sum(np.sum(propagator,axis=0),axis=0)
     return propagator
 
+def propagator_radial_diffusion_sparse(n,dim_rad,rate,wrad,lagtime,
+           lmax,bessel0_zeros,bessels,r,end,start):
+    """calculate the radial propagator (see propagator_radial_diffusion)
+    only in the elements [r,end,start], given as index arrays
+    Returns a 1-D array with the propagator in these elements, no unit."""
+    rmax = np.float64(dim_rad)  # in units [dr]
+    rate_l = np.zeros((n,n),dtype=np.float64)   # N x N
+    propagator = np.zeros(len(r),dtype=np.float64)
+    for l in range(lmax):
+        sink = np.exp(wrad)*bessel0_zeros[l]**2/rmax**2 # sink term D_par(i) * (b_l)**2
+        rate_l[:,:] = rate[:,:]                 # take rate matrix for 1-D diffusion
+        rate_l.ravel()[::n+1] -= sink           # and add sink term
+        mat_exp = scipy.linalg.expm(lagtime*rate_l) # matrix exponential, no unit
+        propagator += bessels[l,r] * mat_exp[end,start]   # no unit
+    return propagator
+
 #=============================
 # TESTING
 #=============================